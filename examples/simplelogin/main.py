@@ -25,6 +25,10 @@ urls = ('/analytics/?', 'waltz.modules.Analytics',
         '/logout/?', 'routes.auth.Logout',
         '/?', 'routes.home.Index')
 
+# Usernames (here, email addresses) must be unique; declaring them
+# in User.unique makes User.registered() an O(1) index lookup
+waltz.User.unique = ('username',)
+
 # Default values for a user's session
 sessions = {'email': None, 'logged': False}
 
@@ -33,8 +37,10 @@ sessions = {'email': None, 'logged': False}
 env = {'split': lambda s, delim: s.split(delim) }
 
 # Setting up and configuring the waltz application. To see all available
-# options, refer to waltz/setup.py
-app = waltz.setup.dancefloor(urls, globals(), sessions=sessions, env=env)
+# options, refer to waltz/setup.py. Passwords are hashed in a pool of
+# 2 worker processes; once 32 hashes are pending, logins get a 503
+app = waltz.setup.dancefloor(urls, globals(), sessions=sessions, env=env,
+                             verifier={'processes': 2, 'maxsize': 32})
 
 if __name__ == "__main__":
     app.run()
@@ -11,7 +11,13 @@
 """
 
 import waltz
-from waltz import User, web, session, render
+from waltz import User, web, session, render, throttle
+from waltz.security import Saturated
+
+def busy():
+    """Too many passwords are being hashed; ask the client to retry"""
+    return web.HTTPError('503 Service Unavailable', {'Retry-After': '1'},
+                         'Too many login attempts in progress, retry shortly')
 
 class Login:
     def GET(self, msg=""):
@@ -19,6 +25,9 @@ class Login:
             msg = "Already logged in"
         return render().login(msg=msg)
 
+    # at most 20 attempts in a burst per IP and 10 per account,
+    # refused before any user is loaded or password hashed
+    @throttle()
     def POST(self):        
         i = web.input(email="", password="")
         if not waltz.utils.valid_email(i.email):
@@ -27,7 +36,11 @@ class Login:
             u = User(i.email)
         except AttributeError:
             return self.GET(msg="no such user")
-        if u.authenticate(i.password):
+        try:
+            authenticated = u.authenticate(i.password)
+        except Saturated:
+            raise busy()
+        if authenticated:
             session().update({'logged': True,
                               'email': i.email})
             raise web.seeother('/')
@@ -42,13 +55,17 @@ class Register:
         if not waltz.utils.valid_email(i.email):
             return self.GET(msg="invalid email")
         try:
-            u = User(i.email)
-        except:
-            u = User.register(i.email, i.password, passwd2=i.password_confirm)
-            session().update({'logged': True,
-                              'email': i.email})
-            raise web.seeother('/')
-        return Login().GET(msg="User already exists")
+            u = User.register(i.email, i.password,
+                              passwd2=i.password_confirm)
+        except Saturated:
+            raise busy()
+        except ValueError as e:
+            # e.g. the user already exists; checked atomically with
+            # the write, so concurrent registrations can't both win
+            return self.GET(msg=str(e))
+        session().update({'logged': True,
+                          'email': i.email})
+        raise web.seeother('/')
 
 class Logout:
     def GET(self):
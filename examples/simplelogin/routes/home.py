@@ -48,8 +48,14 @@ class Index:
         can do so by accessing the web module via waltz.web and by
         following the web.py documentation.
 
+        Pages which rarely change needn't be re-rendered on every
+        request: waltz.render().cached(ttl) renders like
+        waltz.render(), but caches the output for ttl seconds, keyed
+        on the template's arguments (and any session fields named,
+        e.g. waltz.render().cached(300, session=('email',))).
+
         See: http://webpy.org/docs/0.3/templetor
         """
         if waltz.session()['logged']:
-            return waltz.render().index()
+            return waltz.render().cached(300).index()
         raise waltz.web.seeother('/login')
@@ -11,20 +11,39 @@
 
 import unittest
 import os
+import time
 import shutil
+import multiprocessing
+import json
+from datetime import datetime
 from paste.fixture import TestApp
+from lazydb import Db
 import waltz
 from waltz import Account, User, web, storage
 
 USERNAME = "username"
 PASSWD = "password"
 UHASH = 'fe9dfc91b3a89c563a15c1f9d7a1467c08fcb6621a14cfa791014f45bcfac0e3'
+PHASH = 'pbkdf2_sha256$100000$' \
+    'bb66ba818d38deb9d76c08b69dbc4213b8afb9a1c23521953528ae66b78f79a3'
 SALT = 'mh3ot3si9anq'
 EMAIL = "waltz@example.org"
 USER_FIELDS = {'age': 24}
 
 _tmpdir = '%s/tmp' % os.path.dirname(__file__)
 
+WORKERS = 8
+UPDATES = 25
+
+def _hammer_users(dbname, worker):
+    """Worker process for test_users_concurrent: concurrently bumps a
+    shared counter and registers a user of its own
+    """
+    User.change_db(dbname)
+    for n in range(UPDATES):
+        User.update(USERNAME, lambda u: dict(u, age=u['age'] + 1))
+        User.insert({'username': '%s%s-%s' % (USERNAME, worker, n)})
+
 class TestWaltz(unittest.TestCase):
     
     def setUp(self):
@@ -39,16 +58,146 @@ class TestWaltz(unittest.TestCase):
         self.assertTrue(all(item in user.items() for item in USER_FIELDS.items()),
                         "USER_FIELDS: %s did not persist to user: %s "\
                             % (USER_FIELDS, user))
-        self.assertTrue(user.uhash == UHASH,
+        self.assertTrue(user.uhash == PHASH,
                         "waltz.Account.register(%s, %s, salt=%s) " \
                             "expected result hash of " \
                             "%s but generated uhash: %s " \
-                            % (USERNAME, PASSWD, SALT, UHASH, user.uhash))
-        self.assertTrue(user.uhash == UHASH,
-                        "waltz.Account.register(%s, %s, salt=%s) " \
-                            "expected result  of " \
-                            "%s but generated uhash: %s " \
-                            % (USERNAME, PASSWD, SALT, UHASH, user.uhash))
+                            % (USERNAME, PASSWD, SALT, PHASH, user.uhash))
+        self.assertTrue(Account.authenticate(USERNAME, PASSWD, SALT, PHASH))
+        self.assertTrue(Account._hash(USERNAME, SALT, PASSWD, 'sha256') \
+                            == UHASH,
+                        "Legacy sha256 uhash of %s, %s, salt=%s changed" \
+                            % (USERNAME, PASSWD, SALT))
+        self.assertTrue(Account.authenticate(USERNAME, PASSWD, SALT, UHASH),
+                        "Legacy sha256 uhash no longer authenticates")
+        self.assertTrue(not Account.authenticate(USERNAME, 'wrong', SALT,
+                                                 UHASH))
+
+    def test_rehash(self):
+        """Test whether authenticating against an outdated hash
+        upgrades it in place
+        """
+        web.ctx.waltz = storage()
+        web.ctx.waltz.db = '%s/db' % _tmpdir
+        User.insert({'username': USERNAME, 'salt': SALT, 'uhash': UHASH})
+        self.assertTrue(Account.needs_rehash(UHASH) and
+                        not Account.needs_rehash(PHASH))
+        self.assertTrue(not User(USERNAME).authenticate('wrong'))
+        self.assertTrue(User.get(USERNAME)['uhash'] == UHASH,
+                        "Failed login rehashed the password")
+        from waltz.security import Saturated
+        class Busy(object):
+            """Verifies the password, then saturates"""
+            def __init__(self):
+                self.calls = 0
+            def run(self, hasher, *args):
+                self.calls += 1
+                if self.calls > 1:
+                    raise Saturated()
+                return hasher(*args)
+        Account.verifier = Busy()
+        try:
+            self.assertTrue(User(USERNAME).authenticate(PASSWD),
+                            "Saturated rehash failed a correct login")
+        finally:
+            Account.verifier = None
+        self.assertTrue(User.get(USERNAME)['uhash'] == UHASH)
+        self.assertTrue(User(USERNAME).authenticate(PASSWD))
+        self.assertTrue(User.get(USERNAME)['uhash'] == PHASH,
+                        "Login did not upgrade the legacy hash")
+        self.assertTrue(User(USERNAME).authenticate(PASSWD))
+
+    def test_verifier(self):
+        """Test whether a Verifier hashes passwords out of process and
+        sheds requests once saturated
+        """
+        from waltz.security import Verifier, Saturated
+        Account.verifier = Verifier(processes=1, maxsize=1)
+        try:
+            self.assertTrue(Account._hash(USERNAME, SALT, PASSWD) == PHASH)
+            self.assertTrue(Account.authenticate(USERNAME, PASSWD, SALT,
+                                                 PHASH))
+            Account.verifier._slots.acquire()
+            self.assertRaises(Saturated, Account.authenticate, USERNAME,
+                              PASSWD, SALT, PHASH)
+            Account.verifier._slots.release()
+        finally:
+            Account.verifier.close()
+            Account.verifier = None
+
+    def test_throttle(self):
+        """Test whether throttled routes answer 429 once an IP or
+        account has spent its bucket, before the route runs, and
+        whether refilled buckets are evicted
+        """
+        from waltz.ratelimit import Limiter
+        attempts = []
+        accounts = Limiter(rate=1000, burst=2)
+        class Login:
+            @waltz.throttle(ip=Limiter(rate=0.001, burst=3),
+                            account=accounts)
+            def POST(self):
+                attempts.append(web.input().email)
+                return 'ok'
+        app = web.application(('/login', 'Login'), locals())
+        login = lambda email: app.request('/login', method='POST',
+                                          data='email=%s' % email)
+        statuses = [login(email).status for email in ['a', 'A', 'b', 'c']]
+        self.assertTrue(statuses == ['200 OK', '200 OK', '200 OK',
+                                     '429 Too Many Requests'],
+                        "Throttle did not limit by IP: %s" % statuses)
+        self.assertTrue(attempts == ['a', 'A', 'b'],
+                        "Throttled route ran anyway: %s" % attempts)
+        self.assertTrue(int(login('d').headers['Retry-After']) > 1)
+        for n in range(2):
+            accounts.allow('x')
+        self.assertTrue(not accounts.allow('x'),
+                        "Throttle did not limit by account")
+        time.sleep(0.01)
+        accounts._evict(time.time())
+        self.assertTrue(not accounts.buckets,
+                        "Limiter kept buckets which had refilled")
+        flood = Limiter(rate=0.001, burst=1, maxsize=100)
+        for n in range(1000):
+            flood.allow('account%s' % n)
+        self.assertTrue(len(flood.buckets) == 100 and
+                        not flood.allow('account999'),
+                        "Limiter exceeded its maxsize, or dropped a "
+                        "recently used bucket")
+
+    def test_tokens(self):
+        """Test whether salts and tokens are random and url-safe, and
+        signed tokens verify only for their purpose, age and binding
+        """
+        from waltz.security import Entropy, token, randchars
+        from waltz.utils import ALPHANUMERICS
+        entropy = Entropy(size=64)
+        self.assertTrue(len(entropy.read(100)) == 100)
+        self.assertTrue(entropy.read(16) != entropy.read(16))
+        salts = set(Account._salt() for n in range(100))
+        self.assertTrue(len(salts) == 100 and
+                        all(len(s) == 12 and set(s) <= set(ALPHANUMERICS)
+                            for s in salts))
+        self.assertTrue(set(randchars(1000, 'ab')) == set('ab'))
+        self.assertTrue(len(token(16)) == 22 and '=' not in token(16))
+        self.assertRaises(ValueError, Account.token, EMAIL, 'activate')
+        Account.secret = 'secret'
+        try:
+            activate = Account.token(EMAIL, 'activate')
+            self.assertTrue(Account.check_token(activate, 'activate') == EMAIL)
+            self.assertTrue(Account.check_token(activate, 'reset') is None,
+                            "Token was valid for another purpose")
+            self.assertTrue(Account.check_token(activate, 'activate',
+                                                max_age=-1) is None,
+                            "Expired token was valid")
+            reset = Account.token(EMAIL, 'reset', bind=PHASH)
+            self.assertTrue(Account.check_token(reset, 'reset',
+                                                bind=PHASH) == EMAIL)
+            self.assertTrue(Account.check_token(reset, 'reset',
+                                                bind=UHASH) is None,
+                            "Reset token survived a password change")
+        finally:
+            Account.secret = None
 
     def test_run(self):
         middleware = []
@@ -104,8 +253,598 @@ class TestWaltz(unittest.TestCase):
         self.assertTrue(User.delete(USERNAME) is not None,
                         "<waltz.User.delete> " \
                             "Failed to delete user: %s" % USERNAME)
+    def test_user_migration(self):
+        """Test whether users kept in the legacy LazyDB 'users' blob
+        are migrated into the per-record User store
+        """
+        web.ctx.waltz = storage()
+        web.ctx.waltz.db = '%s/db' % _tmpdir
+        user = Account.register(USERNAME, PASSWD, salt=SALT)
+        Db(web.ctx.waltz.db).put('users', {USERNAME: user})
+
+        self.assertTrue(User.get(USERNAME).uhash == user.uhash,
+                        "Legacy user was not migrated to the User store")
+        User.insert(Account.register(USERNAME[::-1], PASSWD))
+        self.assertTrue(Db(web.ctx.waltz.db).get('users').keys() == [USERNAME],
+                        "User store should not write the legacy users blob")
+        self.assertTrue(sorted(User.getall().keys()) ==
+                        sorted([USERNAME, USERNAME[::-1]]),
+                        "User.getall() did not list migrated + new users")
+
+    def test_user_indexes(self):
+        """Test whether User.unique indexes answer registered() and
+        lookup() and are kept current on update and delete
+        """
+        web.ctx.waltz = storage()
+        web.ctx.waltz.db = '%s/db' % _tmpdir
+        User.unique = ('username', 'email')
+        try:
+            User.register(USERNAME, PASSWD, email=EMAIL)
+            self.assertTrue(User.registered(USERNAME))
+            self.assertTrue(User.registered(email=EMAIL))
+            self.assertTrue(User.lookup('email', EMAIL).username == USERNAME)
+            self.assertRaises(ValueError, User.register, USERNAME[::-1],
+                              PASSWD, email=EMAIL)
+            self.assertTrue(not User.registered(USERNAME[::-1]),
+                            "Registration violating User.unique was stored")
+            uhash = User.get(USERNAME).uhash
+            self.assertRaises(ValueError, User.register, USERNAME, 'other')
+            self.assertTrue(User.get(USERNAME).uhash == uhash,
+                            "Registering an existing username overwrote it")
+
+            User.update(USERNAME, lambda u: dict(u, email="x" + EMAIL))
+            self.assertTrue(not User.registered(email=EMAIL),
+                            "Stale email index entry after User.update")
+            self.assertTrue(User.registered(email="x" + EMAIL))
+            User.delete(USERNAME)
+            self.assertTrue(not User.registered(USERNAME))
+            self.assertTrue(User.lookup('email', "x" + EMAIL) is None)
+        finally:
+            User.unique = ()
+        # e.g. an admin script, which doesn't declare User.unique
+        User.register(USERNAME, PASSWD, email=EMAIL)
+        User.unique = ('username', 'email')
+        try:
+            self.assertTrue(User.registered(email=EMAIL),
+                            "Index missed a user written without unique")
+            self.assertRaises(ValueError, User.register, USERNAME[::-1],
+                              PASSWD, email=EMAIL)
+        finally:
+            User.unique = ()
+        self.assertRaises(ValueError, User.register, USERNAME[::-1],
+                          PASSWD, email=EMAIL)
+
+    def test_current_user(self):
+        """Test whether current_user() reads the logged in user once
+        per request, and User.cached reuses it across requests until
+        it's written
+        """
+        web.ctx.waltz = storage()
+        web.ctx.waltz.db = '%s/db' % _tmpdir
+        User.register(USERNAME, PASSWD, email=EMAIL)
+        reads = []
+        get = User.store().__class__.get
+        def counted(store, uid, *args):
+            reads.append(uid)
+            return get(store, uid, *args)
+        User.store().__class__.get = counted
+        try:
+            web.ctx.session = storage(email=None)
+            self.assertTrue(waltz.current_user() is None)
+            web.ctx.session.email = USERNAME
+            user = waltz.current_user()
+            self.assertTrue(user.email == EMAIL and
+                            waltz.current_user() is user)
+            self.assertTrue(reads == [USERNAME],
+                            "current_user() re-read the user: %s" % reads)
+            User.cache_ttl = 60
+            for n in range(3):
+                del web.ctx['waltz_user'] # a new request
+                waltz.current_user()
+            self.assertTrue(reads == [USERNAME] * 2,
+                            "User.cached did not reuse the user: %s" % reads)
+            User.update(USERNAME, lambda u: dict(u, age=1))
+            self.assertTrue(waltz.current_user().age == 1,
+                            "current_user() served a stale user")
+        finally:
+            User.store().__class__.get = get
+            User.cache_ttl = 0
+            User._cache.clear()
+        User.register(USERNAME[::-1], PASSWD, email='x' + EMAIL,
+                      pkey='email')
+        web.ctx.session.email = 'x' + EMAIL
+        user = waltz.current_user()
+        user.age = 2
+        user.save()
+        self.assertTrue(sorted(User.getall().keys()) ==
+                        sorted([USERNAME, 'x' + EMAIL]),
+                        "User.save wrote a record under another key")
+        self.assertTrue(waltz.current_user().age == 2)
+
+    def test_users_concurrent(self):
+        """Stress test: many processes mutating the User store at
+        once must not lose any updates
+        """
+        dbname = '%s/db' % _tmpdir
+        web.ctx.waltz = storage()
+        web.ctx.waltz.db = dbname
+        User.insert({'username': USERNAME, 'age': 0})
+
+        workers = [multiprocessing.Process(target=_hammer_users,
+                                           args=(dbname, w))
+                   for w in range(WORKERS)]
+        for w in workers: w.start()
+        for w in workers: w.join()
+
+        self.assertTrue(all(w.exitcode == 0 for w in workers),
+                        "A User stress test worker crashed")
+        self.assertTrue(User.get(USERNAME).age == WORKERS * UPDATES,
+                        "Lost updates: age is %s, expected %s" \
+                            % (User.get(USERNAME).age, WORKERS * UPDATES))
+        self.assertTrue(len(User.getall()) == 1 + WORKERS * UPDATES,
+                        "Lost inserts: %s users" % len(User.getall()))
+
+    def test_analytics_sink(self):
+        """Test whether the write-behind analytics sink writes emitted
+        events to its log in batches
+        """
+        dbname = '%s/db' % _tmpdir
+        sink = waltz.analytics.Sink(dbname, batch=10, interval=0.05,
+                                    fields=('path', 'status', 'agent'))
+        ctx = storage(status='200 OK', env={'PATH_INFO': '/',
+                                            'HTTP_COOKIE': 'secret'})
+        for n in range(25):
+            ctx.env['HTTP_USER_AGENT'] = str(n)
+            sink.emit(sink.event(ctx, time.time()))
+        sink.flush()
+        time.sleep(0.2)
+        events = list(sink.log.read())
+        self.assertTrue({'path': '/', 'status': 200, 'agent': '0'} in events,
+                        "Events do not follow the sink's schema: %s" \
+                            % events)
+        self.assertTrue(sorted(int(e['agent']) for e in events) == range(25),
+                        "Sink lost or duplicated events: %s" % events)
+        self.assertTrue(sink.stats['written'] == 25 and
+                        sink.stats['batches'] >= 3,
+                        "Sink did not write in batches: %s" % sink.stats)
+
+    def test_analytics_log(self):
+        """Test whether the analytics log rotates segments and streams
+        back events filtered by since, until and limit
+        """
+        log = waltz.analytics.Log('%s/db.analytics' % _tmpdir,
+                                  segment_size=64)
+        now = int(time.time()) - 60
+        for t in range(10):
+            log.append(('time', 'path'), [(now + t, '/%s' % t)])
+        self.assertTrue(len(log.segments()) > 1,
+                        "Log did not rotate its segments")
+        self.assertTrue([e['time'] - now for e in log.read()] == range(10))
+        self.assertTrue([e['path'] for e in
+                         log.read(since=now + 3, until=now + 5)] ==
+                        ['/3', '/4', '/5'])
+        self.assertTrue(len(list(log.read(since=now + 2, limit=4))) == 4)
+        log.append(('path',), [('/new',)])
+        self.assertTrue(list(log.read())[-1] == {'path': '/new'},
+                        "Log did not start a segment for the new schema")
+
+    def test_analytics_rollups(self):
+        """Test whether rollups count hits per minute, route and
+        status, and prune minutes past their retention
+        """
+        rollups = waltz.analytics.Rollups('%s/db.rollups' % _tmpdir,
+                                          retention=60)
+        now = time.time()
+        fields = ('time', 'path', 'method', 'status')
+        rollups.add(fields, [(now - 120, '/', 'GET', 200),
+                             (now - 60, '/', 'GET', 200),
+                             (now - 60, '/login', 'POST', 303)])
+        rollups.add(fields, [(now, '/', 'GET', 200),
+                             (now - 7200, '/', 'GET', 200)])
+        self.assertTrue(rollups.query(now - 3600, now) ==
+                        [{'path': '/', 'hits': 3},
+                         {'path': '/login', 'hits': 1}])
+        self.assertTrue(rollups.query(now - 3600, now, by=('status',),
+                                      method='POST') ==
+                        [{'status': 303, 'hits': 1}])
+        self.assertTrue(rollups.query(now - 7200, now - 3600) == [],
+                        "Rollups did not prune minutes past retention")
+        started = time.time()
+        self.assertTrue(rollups.query(0, now * 1000) ==
+                        rollups.query(now - 3600, now))
+        self.assertTrue(time.time() - started < 1,
+                        "Rollups.query scanned minutes past retention")
+
+    def test_metrics(self):
+        """Test whether waltz.metrics records only when enabled and
+        exports histograms in Prometheus format
+        """
+        registry = waltz.metrics.Registry()
+        registry.observe('waltz_request_seconds', 0.2, route='Index')
+        self.assertTrue(not registry.histograms,
+                        "Disabled metrics registry recorded a metric")
+        registry.enabled = True
+        for seconds in (0.002, 0.02, 0.2):
+            registry.observe('waltz_request_seconds', seconds, route='Index')
+        registry.inc('waltz_requests_total', route='Index', status='200')
+        exported = waltz.metrics.prometheus(registry)
+        for line in ['waltz_request_seconds_bucket{route="Index",le="0.01"} 1',
+                     'waltz_request_seconds_bucket{route="Index",le="+Inf"} 3',
+                     'waltz_request_seconds_count{route="Index"} 3',
+                     'waltz_requests_total{route="Index",status="200"} 1']:
+            self.assertTrue(line in exported.splitlines(),
+                            "%s missing from export:\n%s" % (line, exported))
+
+    def test_profiler_sampler(self):
+        """Test whether the sampling profiler captures other threads'
+        stacks and folds them into collapsed (flamegraph) format
+        """
+        import threading
+        from waltz.modules import Sampler
+        done = threading.Event()
+        sleeper = threading.Thread(target=done.wait)
+        sleeper.start()
+        try:
+            stacks = Sampler(interval=0.01).sample(0.1)
+        finally:
+            done.set()
+            sleeper.join()
+        collapsed = Sampler.collapsed(stacks)
+        self.assertTrue(any(line.startswith('__bootstrap') and
+                            'wait (threading.py' in line
+                            for line in collapsed.splitlines()),
+                        "Sampled stacks missing waiting thread:\n%s" \
+                            % collapsed)
+
+    def test_cached_session_store(self):
+        """Test whether CachedStore serves sessions from memory, skips
+        unchanged writes, notices writes by other workers and evicts
+        least recently used sessions
+        """
+        from waltz.sessions import CachedStore, DiskStore
+        disk = DiskStore('%s/sessions' % _tmpdir)
+        store = CachedStore(disk, capacity=2)
+        store['a'] = {'logged': True}
+        os.utime(disk._get_path('a'), (1, 1))
+        store._cache('a', disk.stat('a'), store.cache['a'][1])
+        self.assertTrue(store['a'] == {'logged': True})
+        store['a'] = {'logged': True}
+        self.assertTrue(disk.mtime('a') > 1,
+                        "Unchanged session was neither touched nor written")
+        disk['a'] = {'logged': False}  # another worker's write
+        os.utime(disk._get_path('a'), (2, 2))
+        self.assertTrue(store['a'] == {'logged': False},
+                        "CachedStore served a stale session")
+        store['b'], store['c'] = {}, {}
+        self.assertTrue(store.cache.keys() == ['b', 'c'],
+                        "CachedStore did not evict the LRU session")
+        class Racing(DiskStore):
+            def __getitem__(self, key):
+                value = DiskStore.__getitem__(self, key)
+                if not value['logged']: # another worker logs in
+                    DiskStore.__setitem__(self, key, {'logged': True})
+                return value
+        racing = CachedStore(Racing('%s/sessions' % _tmpdir))
+        racing['r'] = {'logged': False}
+        racing.cache.clear()
+        self.assertTrue(racing['r'] == {'logged': False})
+        self.assertTrue(racing['r'] == {'logged': True},
+                        "CachedStore cached a session under a newer stat")
+        os.utime(disk._get_path('b'), (1, 1))
+        os.makedirs('%s/sessions/stale' % _tmpdir)
+        store.sweep(60)
+        self.assertTrue('b' not in store and 'c' in store,
+                        "CachedStore.sweep did not expire idle sessions")
+        sweeps = []
+        class Failing(DiskStore):
+            def cleanup(self, timeout):
+                sweeps.append(timeout)
+                raise OSError("cleanup failed")
+        failing = CachedStore(Failing('%s/sessions' % _tmpdir),
+                              interval=0.01,
+                              logpath='%s/events.log' % _tmpdir)
+        failing.cleanup(60)
+        time.sleep(0.1)
+        failing.close()
+        self.assertTrue(len(sweeps) > 1,
+                        "Session sweeper died after a failed sweep")
+
+    def test_sharded_session_store(self):
+        """Test whether flat session directories migrate into the
+        sharded layout and expired sessions are swept incrementally
+        """
+        from waltz.sessions import DiskStore, ShardedStore, CachedStore, \
+            shard
+        root = '%s/sessions' % _tmpdir
+        flat = DiskStore(root)
+        for n in range(5):
+            flat['%040x' % n] = {'n': n}
+        os.utime(flat._get_path('%040x' % 0), (1, 1))
+        store = ShardedStore(root, batch=2)
+        self.assertTrue(shard(root, store) == 5)
+        self.assertTrue(not [f for f in os.listdir(root)
+                             if os.path.isfile(os.path.join(root, f))],
+                        "shard() left session files in the flat directory")
+        self.assertTrue(store['%040x' % 3] == {'n': 3})
+        passes = [store.cleanup(60) for n in range(3)]
+        self.assertTrue(passes == [False, False, True],
+                        "ShardedStore.cleanup was not incremental: %s" \
+                            % passes)
+        self.assertTrue('%040x' % 0 not in store and '%040x' % 1 in store,
+                        "ShardedStore.cleanup did not expire sessions")
+        stores = []
+        class Store:
+            def GET(self):
+                stores.append(web.ctx.session.store)
+        app = waltz.setup.dancefloor(
+            ('/', 'Store'), {'__file__': '%s/main.py' % _tmpdir,
+                             'Store': Store},
+            sessions={}, debug=False, session_store=store)
+        app.request('/')
+        stores[0].close()
+        self.assertTrue(isinstance(stores[0], CachedStore) and
+                        stores[0].store is store,
+                        "ShardedStore was not put behind a CachedStore")
+
+    def test_cookie_session_store(self):
+        """Test whether CookieStore round-trips sessions through a
+        signed cookie and rejects tampered or foreign cookies
+        """
+        from waltz.security import sign, unsign
+        from waltz.sessions import CookieStore
+        self.assertTrue(unsign(sign('v', 'k', 'p'), 'k', 'p') == 'v')
+        self.assertTrue(unsign(sign('v', 'k', 'p'), 'k', 'q') is None)
+        self.assertTrue(unsign(sign('v', 'k'), 'k', max_age=-1) is None)
+        store = CookieStore('secret')
+        session = {'email': 'user@example.com', 'logged': True}
+        def request(cookie=''):
+            web.ctx.clear()
+            web.ctx.update(env={'HTTP_COOKIE': cookie}, headers=[],
+                           homepath='')
+        request()
+        store['sid'] = session
+        cookie = web.ctx.headers[0][1].split(';')[0]
+        request(cookie)
+        self.assertTrue(store['sid'] == session,
+                        "CookieStore did not round-trip the session")
+        self.assertTrue('other' not in store,
+                        "CookieStore accepted another session's cookie")
+        name, signed = cookie.split('=', 1)
+        tampered = store.encode(dict(session, email='admin@example.com'))
+        request('%s=%s.%s' % (name, tampered, signed.split('.', 1)[1]))
+        self.assertTrue('sid' not in store,
+                        "CookieStore accepted a tampered cookie")
+
+    def test_lazy_sessions(self):
+        """Test whether sessions are only loaded when accessed and
+        only saved when changed
+        """
+        from waltz.sessions import Session, DiskStore
+        class Static:
+            def GET(self):
+                return 'static'
+        class Read:
+            def GET(self):
+                return str(session['n'])
+        class Write:
+            def GET(self):
+                session['n'] += 1
+                return str(session['n'])
+        app = web.application(('/static', 'Static', '/read', 'Read',
+                               '/write', 'Write'), locals())
+        path = '%s/sessions' % _tmpdir
+        os.makedirs(path)
+        session = Session(app, DiskStore(path), initializer={'n': 0})
+        request = lambda url, cookie='': app.request(
+            url, env={'HTTP_COOKIE': cookie})
+        for url in ['/static', '/read']:
+            r = request(url)
+            self.assertTrue(not os.listdir(path) and
+                            'Set-Cookie' not in r.headers,
+                            "%s saved an untouched session" % url)
+        cookie = request('/write').headers['Set-Cookie'].split(';')[0]
+        sid = cookie.split('=', 1)[1]
+        self.assertTrue(os.listdir(path) == [sid])
+        os.utime('%s/%s' % (path, sid), (1, 1))
+        self.assertTrue(request('/read', cookie).data == '1')
+        self.assertTrue(1 < os.stat('%s/%s' % (path, sid)).st_mtime,
+                        "Reading the session did not postpone its expiry")
+        self.assertTrue(request('/write', cookie).data == '2')
+
+    def test_template_cache(self):
+        """Test whether templates are compiled once per process, load
+        from the on-disk cache and are only checked for changes in
+        debug mode
+        """
+        from waltz import rendering
+        loc, cachedir = '%s/templates' % _tmpdir, '%s/tplc' % _tmpdir
+        with open('%s/hello.html' % loc, 'w') as f:
+            f.write('$def with (name)\nhello $name\n')
+        render = rendering.Render(loc, check=False, cachedir=cachedir)
+        debug = rendering.Render(loc, check=True, cachedir=cachedir)
+        self.assertTrue(render.precompile() == len(os.listdir(cachedir)))
+        self.assertTrue(unicode(render.hello('mek')) == u'hello mek\n')
+        rendering._codes.clear()
+        compile = web.template.Template.compile_template
+        def fail(*args):
+            raise AssertionError("Template compiled despite cache")
+        web.template.Template.compile_template = fail
+        try:
+            self.assertTrue(unicode(debug.hello('mek')) == u'hello mek\n')
+        finally:
+            web.template.Template.compile_template = compile
+        with open('%s/hello.html' % loc, 'w') as f:
+            f.write('$def with (name)\nhi $name\n')
+        self.assertTrue(unicode(render.hello('mek')) == u'hello mek\n',
+                        "Template was checked for changes outside debug")
+        self.assertTrue(unicode(debug.hello('mek')) == u'hi mek\n',
+                        "Changed template was not recompiled in debug")
+
+    def test_output_cache(self):
+        """Test whether rendered output is cached per arguments and
+        session fields, expires, and is evicted to stay under its cap
+        """
+        from waltz import rendering
+        loc = '%s/templates' % _tmpdir
+        with open('%s/hello.html' % loc, 'w') as f:
+            f.write('$def with (name)\nhello $name $ctx.session.email\n')
+        cache = rendering.OutputCache(maxsize=50)
+        render = rendering.Render(loc, check=False,
+                                  globals={'ctx': web.ctx})
+        cached = rendering.Cached(render, 60, session=('email',),
+                                  cache=cache)
+        web.ctx.session = storage({'email': 'a@example.org'})
+        self.assertTrue(unicode(cached.hello('x')) == \
+                            u'hello x a@example.org\n')
+        web.ctx.session.email = 'b@example.org'
+        self.assertTrue(unicode(cached.hello('x')) == \
+                            u'hello x b@example.org\n',
+                        "Output cache ignored the session field")
+        web.ctx.session.email = 'a@example.org'
+        cached.hello('x')
+        self.assertTrue(cache.stats == {'miss': 2, 'hit': 1})
+        cached.hello('y')
+        self.assertTrue(cache.stats.eviction == 1 and cache.size <= 50,
+                        "Output cache exceeded its maxsize")
+        expired = rendering.Cached(render, -1, cache=cache)
+        expired.hello('z')
+        expired.hello('z')
+        self.assertTrue(cache.stats.miss == 5,
+                        "Output cache served expired output")
+
+    def test_streaming(self):
+        """Test whether streamed pages yield the base's head before
+        rendering the page, and feeds render items as consumed
+        """
+        from waltz import rendering
+        from waltz.modules import RSS
+        loc = '%s/templates' % _tmpdir
+        with open('%s/base.html' % loc, 'w') as f:
+            f.write('$def with (content)\n<title>$content.title</title>'
+                    '$:content</html>\n')
+        with open('%s/rows.html' % loc, 'w') as f:
+            f.write('$def with (rows)\n$for row in rows:\n    <p>$row</p>\n')
+        render = rendering.Render(loc, base='base', check=False)
+        rendered = []
+        def rows():
+            for n in range(1000):
+                rendered.append(n)
+                yield n
+        stream = render.stream(size=1024, title='Rows').rows(rows())
+        self.assertTrue(stream.next() == '<title>Rows</title>')
+        self.assertTrue(not rendered, "Page rendered before head was sent")
+        body = ''.join(stream)
+        self.assertTrue(body.endswith('</html>\n') and
+                        body.count('<p>') == 1000)
+        rss = RSS(title='feed')
+        items = ({'title': 'item %s' % n} for n in range(1000))
+        stream = rss.stream(items, size=1024)
+        self.assertTrue('<title>feed</title>' in stream.next())
+        self.assertTrue(items.next()['title'] != 'item 999',
+                        "RSS.stream rendered every item up front")
+        self.assertTrue(''.join(stream).endswith('</rss>\n'))
+
+    def test_rss_conditional_get(self):
+        """Test whether feeds are windowed, carry ETag/Last-Modified
+        and answer repeat polls with 304 until their items change
+        """
+        from waltz.modules import rss
+        items = [{'title': 'item %s' % n, 'date': 1700000000 + n}
+                 for n in range(5)]
+        calls = []
+        def items_func():
+            calls.append(1)
+            return iter(items)
+        Feed = rss(items_func, title='feed', limit=3)
+        app = web.application(('/feed', 'Feed'), locals())
+        r = app.request('/feed')
+        self.assertTrue(r.data.count('<item>') == 3,
+                        "Feed ignored its item window")
+        self.assertTrue(r.headers['Last-Modified'] == \
+                            web.httpdate(datetime.utcfromtimestamp(
+                    1700000002)))
+        etag = r.headers['ETag']
+        for env in [{'HTTP_IF_NONE_MATCH': etag},
+                    {'HTTP_IF_MODIFIED_SINCE': r.headers['Last-Modified']}]:
+            self.assertTrue(app.request('/feed', env=env).status == \
+                                '304 Not Modified')
+        items[0]['title'] = 'changed'
+        r = app.request('/feed', env={'HTTP_IF_NONE_MATCH': etag})
+        self.assertTrue(r.status == '200 OK' and 'changed' in r.data,
+                        "Changed feed was not re-rendered")
+        self.assertTrue(len(calls) == 4)
+        modified = r.headers['Last-Modified']
+        items[1].update(title='edited', updated=1700000100)
+        worker = web.application(('/feed', rss(items_func, title='feed',
+                                              limit=3)), locals())
+        for app in [app, worker]: # and a freshly started worker
+            r = app.request('/feed', env={'HTTP_IF_MODIFIED_SINCE':
+                                              modified})
+            self.assertTrue(r.status == '200 OK' and 'edited' in r.data,
+                            "Edit of an older item was answered with 304")
+            self.assertTrue(r.headers['Last-Modified'] == \
+                                web.httpdate(datetime.utcfromtimestamp(
+                        1700000100)))
+
+    def test_feed_formats(self):
+        """Test whether feeds negotiate RSS, Atom and JSON Feed from the
+        same items, each with its own ETag
+        """
+        from xml.dom import minidom
+        from waltz.modules import rss
+        items = [{'title': 'a & b', 'link': 'http://example.org/1',
+                  'date': 1400000000}]
+        Feed = rss(lambda: items, title='feed')
+        app = web.application(('/feed', 'Feed'), locals())
+        formats = {'?format=atom': 'application/atom+xml',
+                   '?format=json': 'application/feed+json',
+                   '': 'application/xml'}
+        for query, content_type in formats.items():
+            r = app.request('/feed' + query)
+            self.assertTrue(r.headers['Content-Type'] == content_type)
+        atom = minidom.parseString(app.request('/feed?format=atom').data)
+        self.assertTrue(atom.getElementsByTagName('title')[1]
+                        .firstChild.data == 'a & b')
+        accept = 'application/atom+xml;q=0.5, application/feed+json'
+        r = app.request('/feed', env={'HTTP_ACCEPT': accept})
+        feed = json.loads(r.data)
+        self.assertTrue(feed['items'][0]['date_published'] == \
+                            '2014-05-13T16:53:20Z')
+        self.assertTrue(app.request('/feed', env={
+                    'HTTP_IF_NONE_MATCH': r.headers['ETag']}).status == \
+                            '200 OK',
+                        "RSS was validated by the JSON Feed's ETag")
+        template = '$def with (items, title, author)\n$title by $author\n'
+        Custom = rss(lambda: items, template=template, title='feed',
+                     author='mek')
+        app = web.application(('/custom', 'Custom'), locals())
+        self.assertTrue(app.request('/custom').data == 'feed by mek\n')
+        self.assertTrue(app.request('/custom?format=atom').status == \
+                            '404 Not Found',
+                        "Custom RSS template was served as Atom")
+
+    def test_rss_dates(self):
+        """Test whether the channel header is rendered once and dated
+        by the newest item, in RFC 822 format
+        """
+        from waltz.modules import RSS
+        rss = RSS(title='feed')
+        rss.channel = [part.replace('feed', 'pre-rendered')
+                       for part in rss.channel]
+        feed = rss.feed([{'title': 'old', 'date': datetime(2013, 1, 1)},
+                         {'title': 'new', 'date': 1400000000}])
+        self.assertTrue('<title>pre-rendered</title>' in feed)
+        newest = 'Tue, 13 May 2014 16:53:20 GMT'
+        self.assertTrue('<pubdate>%s</pubdate>' % newest in feed and
+                        '<lastbuilddate>%s</lastbuilddate>' % newest in feed,
+                        "Feed was not dated by its newest item")
+        self.assertTrue('<pubdate>Tue, 01 Jan 2013 00:00:00 GMT</pubdate>'
+                        in feed)
+
     def tearDown(self):
         if os.path.isfile('db'): os.remove('db')
+        if os.path.isdir('db.users'): shutil.rmtree('db.users')
+        User._migrated.clear()
         self.assertTrue(os.path.exists(_tmpdir),
                         "Can't find the tmp directory <Dir: %s>" \
                             ", it should exist!" % _tmpdir)
@@ -9,7 +9,12 @@ __author__ = [
 __license__ = "public domain"
 __contributors__ = "see AUTHORS"
 
+import os
+import time
+import errno
 import logging
+import threading
+from collections import Mapping, OrderedDict
 import web
 from lazydb import Db
 
@@ -25,21 +30,41 @@ render = lambda: getattr(web.ctx, 'render', None)
 slender = lambda: getattr(web.ctx, 'slender', None)
 # db for waltz analytics, etc.
 db = lambda: Db(web.ctx['waltz']['db'])
+dbpath = lambda: web.ctx['waltz']['db']
 log = lambda msg, lbl='info': logger(web.ctx['waltz']['logging'], msg, method=lbl)
 
-from security import Account
+from security import Account, Saturated
 from decorations import *
 from utils import *
 from treasury import *
 from setup import *
 from modules import rss
 from utils import Storage
+from store import RecordStore
 
 class User(Account, Storage):
-    """Extends Account to use LazyDB as Datastore"""
+    """Extends Account to use a RecordStore (one file per user) as
+    Datastore. Users previously kept in the LazyDB 'users' key are
+    migrated the first time the store is opened.
+    """
 
     udb = 'users'
     db = staticmethod(db)
+    dbpath = staticmethod(dbpath)
+    # fields whose values must be unique across users. Each is backed
+    # by an index (value -> uid) making registered() and lookup() O(1).
+    # Once built, an index is kept current (and enforced) by every
+    # writer, whether or not it declares the field unique (see
+    # User.indexed). Lookups of other fields, but for the primary key,
+    # read every user
+    unique = ()
+    _migrated = set()
+    # seconds for which User.cached (and so current_user) may reuse a
+    # user read by an earlier request in this process; 0 disables it
+    cache_ttl = 0
+    cache_size = 1024
+    _cache = OrderedDict() # (dbpath, udb, uid) -> (expires, user)
+    _cache_lock = threading.Lock()
 
     def __init__(self, uid, user=None):
         """
@@ -47,9 +72,11 @@ class User(Account, Storage):
         * Provide ability to self.save()
         * Extend __init__ to populate User obj as Storage
         """
-        u = user if user else self.get(uid)
+        u = user if user is not None else self.store().get(uid)
         if u is None:
             raise AttributeError("No user found with id: %s" % uid)
+        # kept as an attribute, rather than an item of the user record
+        self.__dict__['_uid'] = uid
         for k, v in u.items():
             setattr(self, k, v)
 
@@ -62,17 +89,143 @@ class User(Account, Storage):
         existing databased user (if it exists) with this instance of
         the User or insert this User otherwise
         """
-        users = User.getall()
-        users[self.username] = dict(self)
-        return self.db().put(self.udb, users)
+        return self._write(self._uid, self)
+
+    @classmethod
+    def store(cls):
+        """Returns the RecordStore which holds one record per user,
+        located next to the waltz db at <db>.users
+        """
+        store = RecordStore('%s.%s' % (cls.dbpath(), cls.udb))
+        if store.path not in cls._migrated:
+            cls.migrate(store)
+        return store
+
+    @classmethod
+    def migrate(cls, store):
+        """One-shot migration of users from the legacy layout (a
+        single dict of every user pickled under the LazyDB key
+        'users') into store, one record per user. A .migrated marker
+        within the store records that the migration has run. The
+        legacy key is left intact but is no longer read or written.
+        """
+        marker = os.path.join(store.path, '.migrated')
+        if not os.path.exists(marker):
+            with store.lock():
+                if not os.path.exists(marker):
+                    for uid, usr in cls.db().get(cls.udb, default={}).items():
+                        if not store.has(uid):
+                            store.put(uid, dict(usr))
+                    open(marker, 'w').close()
+        cls._migrated.add(store.path)
+
+    @classmethod
+    def index(cls, field):
+        """Returns the RecordStore which maps each value of the unique
+        field to the id of the user holding it. The index is built
+        from existing users the first time it is opened.
+        """
+        store = cls.store()
+        index = RecordStore(os.path.join(store.path, 'index', field))
+        marker = os.path.join(index.path, '.built')
+        if not os.path.exists(marker):
+            with store.lock():
+                if not os.path.exists(marker):
+                    for uid, usr in store.iteritems():
+                        if usr.get(field) not in (None, ''):
+                            index.put(usr[field], uid)
+                    if not os.path.isdir(index.path):
+                        os.makedirs(index.path)
+                    open(marker, 'w').close()
+        return index
+
+    @classmethod
+    def indexed(cls, store=None):
+        """Returns the fields which are indexed, and so kept unique:
+        those declared in User.unique and any other whose index has
+        been built in the store (by whichever process), so that users
+        written by a process which doesn't declare User.unique (e.g.
+        an admin script) still update and respect every index
+        """
+        path = os.path.join((store or cls.store()).path, 'index')
+        try:
+            built = sorted(f for f in os.listdir(path) if os.path.exists(
+                    os.path.join(path, f, '.built')))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            built = []
+        return tuple(cls.unique) + tuple(f for f in built
+                                         if f not in cls.unique)
+
+    @classmethod
+    def lookup(cls, field, value, safe=False):
+        """Returns the User whose field equals value, or None. O(1)
+        for indexed fields (see User.indexed) and for the primary key;
+        otherwise falls back to a linear scan over every user.
+        """
+        if field in cls.indexed():
+            uid = cls.index(field).get(value)
+            usr = cls.store().get(uid) if uid is not None else None
+            if usr is None or usr.get(field) != value:
+                # no such value, or a stale index entry
+                return None
+            return cls(uid, user=(usr if not safe else cls._publishable(usr)))
+        usr = cls.store().get(value)
+        if usr is not None and usr.get(field) == value:
+            return cls(value, user=(usr if not safe else cls._publishable(usr)))
+        for uid, usr in cls.store().iteritems():
+            if usr.get(field) == value:
+                return cls(uid, user=(usr if not safe else cls._publishable(usr)))
+
+    @classmethod
+    def _write(cls, uid, usr):
+        """Writes usr under uid, enforcing and maintaining the indexes
+        of unique fields (see User.indexed). Raises ValueError if
+        another user already holds one of usr's unique values. The
+        check and the write happen atomically under the store's lock.
+        """
+        usr = dict(usr)
+        store = cls.store()
+        with store.lock():
+            fields = cls.indexed(store)
+            old = store.get(uid) if fields else None
+            for field in fields:
+                value = usr.get(field)
+                if value in (None, '') or (old or {}).get(field) == value:
+                    continue
+                owner = cls.index(field).get(value)
+                if owner not in (None, uid) and \
+                        (store.get(owner) or {}).get(field) == value:
+                    raise ValueError("A user with %s '%s' already exists"
+                                     % (field, value))
+            store.put(uid, usr)
+            cls._reindex(uid, old, usr, fields)
+            cls._invalidate(uid)
+        return usr
+
+    @classmethod
+    def _reindex(cls, uid, old, new, fields=None):
+        """Moves uid's index entries from the values of user old to
+        those of user new (either may be None)
+        """
+        for field in (fields if fields is not None else cls.indexed()):
+            before = (old or {}).get(field)
+            after = (new or {}).get(field)
+            if before == after:
+                continue
+            index = cls.index(field)
+            if before not in (None, '') and index.get(before) == uid:
+                index.delete(before)
+            if after not in (None, ''):
+                index.put(after, uid)
 
     @classmethod
     def getall(cls, safe=False):
-        users = cls.db().get(cls.udb, default={}, touch=True)
-        for uid, user in users.items():           
-            u = (user if not safe else cls._publishable(user))
-            users[uid] = cls(uid, user=u)
-        return users
+        """Returns a read-only Users mapping of uid -> User which only
+        reads and builds a User when it is accessed
+        """
+        return Users(cls, safe=safe)
 
     @classmethod
     def get(cls, uid, safe=False):
@@ -80,14 +233,12 @@ class User(Account, Storage):
         params:
             uid - the user id which to fetch
             safe - return users without secure fields like salt and hash
-            db - provide your own instantiated lazydb.Db() connector
         """
         if uid is not None:
-            users = cls.getall()
-            try:
-                return users[uid] if not safe else cls._publishable(users[uid])
-            except KeyError:
-                return None
+            user = cls.store().get(uid)
+            if user is not None:
+                u = (user if not safe else cls._publishable(user))
+                return cls(uid, user=u)
 
     @classmethod
     def _publishable(cls, usr, *args):
@@ -103,54 +254,126 @@ class User(Account, Storage):
 
     @classmethod
     def insert(cls, usr, pkey='username'):
-        """Appends usr to users in db and returns the
-        id of the new user.
-        
+        """Writes usr to the users db and returns the id of the new
+        user. Raises ValueError if a user with that id already exists
+        (use replace or update to change an existing user).
+
         params:
             usr - dictionary or Storage
         """
-        users = cls.db().get(cls.udb, default={}, touch=True)
         uid = usr[pkey]
-        users[uid] = usr
-        users = cls.db().put(cls.udb, users)
+        store = cls.store()
+        with store.lock():
+            if store.has(uid):
+                raise ValueError("A user with %s '%s' already exists"
+                                 % (pkey, uid))
+            cls._write(uid, usr)
         return uid
 
     @classmethod
     def replace(cls, uid, usr):
-        users = cls.db().get(cls.udb, {}, touch=True)
-        users[uid] = usr
-        cls.db().put(cls.udb, users)
+        cls._write(uid, usr)
         return usr
 
     @classmethod
     def update(cls, uid, func=lambda x: x):
         """Updates a given user by applying a func to it. Defaults to
-        identity function
+        identity function. The read, func and write happen atomically
+        with respect to other threads and processes, so concurrent
+        updates are never lost.
         """
-        users = cls.db().get(cls.udb, default={}, touch=True)
-        user = func(users[uid])
-        users[uid] = user
-        cls.db().put('users', users)
+        store = cls.store()
+        with store.lock():
+            user = store.get(uid)
+            if user is None:
+                raise KeyError(uid)
+            user = func(dict(user))
+            cls._write(uid, user)
         return user
 
     @classmethod
     def delete(cls, uid):
-        users = cls.db().get(cls.udb, default={}, touch=True)
-        try:
-            del users[uid]
-            return cls.db().put(cls.udb, users)
-        except KeyError:
-            return False
+        store = cls.store()
+        with store.lock():
+            old = store.get(uid)
+            if store.delete(uid):
+                cls._reindex(uid, old, None)
+                cls._invalidate(uid)
+                return True
+        return False
+
+    @classmethod
+    def cached(cls, uid):
+        """Returns User.get(uid), reusing the user read by an earlier
+        call if that was within the last User.cache_ttl seconds. Any
+        write to the user by this process (save, insert, replace,
+        update, delete) drops it from the cache; writes by other
+        processes may go unseen for up to cache_ttl seconds.
+        """
+        if not cls.cache_ttl or uid is None:
+            return cls.get(uid)
+        key = cls.dbpath(), cls.udb, uid
+        now = time.time()
+        pending = object()
+        with cls._cache_lock:
+            entry = cls._cache.pop(key, None)
+            if entry is not None and entry[0] > now:
+                cls._cache[key] = entry
+            else:
+                # replaced by the user once read, unless invalidated
+                cls._cache[key] = entry = (0, pending)
+        user = entry[1]
+        if user is pending:
+            user = cls.store().get(uid)
+            with cls._cache_lock:
+                if cls._cache.get(key, (0, None))[1] is pending:
+                    cls._cache[key] = (now + cls.cache_ttl, user)
+                while len(cls._cache) > cls.cache_size:
+                    cls._cache.popitem(last=False)
+        return cls(uid, user=user) if user is not None else None
+
+    @classmethod
+    def _invalidate(cls, uid):
+        """Drops uid from the cache of User.cached, and from this
+        request's current_user()
+        """
+        with cls._cache_lock:
+            cls._cache.pop((cls.dbpath(), cls.udb, uid), None)
+        memo = web.ctx.get('waltz_user')
+        if memo is not None and memo[0][1] == uid:
+            del web.ctx['waltz_user']
 
     def authenticate(self, passwd):
-        """Instance level authentication for a User
+        """Instance level authentication for a User. If passwd is
+        correct but the user's hash was made with an older scheme or
+        rounds (see Account.scheme), the hash is upgraded in place
+        (unless Account.verifier is saturated, see
+        waltz.security.Verifier).
 
         usage:
         >>> u = User('username')
         >>> u.authenticate('password')
         True
         """
-        return self.easyauth(dict(self), passwd)
+        if not self.easyauth(dict(self), passwd):
+            return False
+        old = self['uhash']
+        if self.needs_rehash(old):
+            try:
+                new = self._hash(self['username'], self['salt'], passwd)
+            except Saturated:
+                return True # upgrade on a later login instead
+            def rehash(user):
+                # unless the password was changed meanwhile
+                if user.get('uhash') == old:
+                    user['uhash'] = new
+                return user
+            try:
+                self.update(self._uid, rehash)
+            except KeyError:
+                pass # not (or no longer) stored
+            self['uhash'] = new
+        return True
 
     @classmethod
     def easyauth(cls, u, passwd):
@@ -161,8 +384,7 @@ class User(Account, Storage):
                 ['salt', 'uhash', 'username']
         """
         if u and all(key in u for key in ['username', 'salt', 'uhash']):
-            return Account.authenticate(u['username'], passwd,
-                                        u['salt'], u['uhash'])
+            return cls._verify(u['username'], passwd, u['salt'], u['uhash'])
         raise TypeError("Account._auth expects user object 'u' with " \
                             "keys: ['salt', 'uhash', 'username']. " \
                             "One or more items missing from user dict u.")
@@ -173,8 +395,9 @@ class User(Account, Storage):
         """Calls Account's regiser method and then injects **kwargs
         (additional user information) into the resulting dictionary.
         
-        XXX Additional constraints required (like check for multiple
-        emails + other keys which should be 'unique')
+        Raises ValueError if a user with the same primary key (pkey)
+        exists, or if a value of any field declared in User.unique
+        (e.g. email) already belongs to another user.
 
         :param pkey: the string name of the key which will be used as
                      a primary key for storing/referencing/indexing
@@ -185,7 +408,7 @@ class User(Account, Storage):
         ...               email="username@domain.org", salt='123456789',
         ...               pkey="email")
         <Storage {'username': 'username',
-        'uhash': '021d98a32375ed850f459fe484c3ab2e352fc2801ef13eae274103befc9d0274', 
+        'uhash': 'pbkdf2_sha256$100000$6c046a79fb276f1857bbad4772bf8c09cf20086656e640d17642cfe595fbd633',
         'salt': '123456789', 'email': 'username@domain.org'}>
         """
         #if not cls.registered(username):
@@ -193,30 +416,98 @@ class User(Account, Storage):
                                          email=email, salt=salt, **kwargs)
         user.enabled = enabled
         uid = cls.insert(user, pkey=pkey)
-        return cls(user.username, user=user)
+        return cls(uid, user=user)
 
     @classmethod
-    def registered(cls, username):
-        """predicate which answers whether a username exists in the User db.
-
-        XXX registered() should be made more flexible to accomomdate
-        for keys other than username in the case where there are
-        UNIQUEness constraints on user attributes, such as email. This
-        may mean providing **kwargs of unique User attributes and
-        values and iterating over each user in the Db (this linear
-        approach is a caveat of lazydb) to ensure UNIQUEness.
+    def registered(cls, username=None, **kwargs):
+        """predicate which answers whether a username (or any of the
+        user attributes given as **kwargs, such as email) exists in
+        the User db. Lookups of indexed fields (those declared in
+        User.unique) and of the primary key are O(1); lookups of other
+        fields read every user (see User.lookup).
 
         >>> from waltz import User
+        >>> User.unique = ('username', 'email')
         >>> User.registered("username")
         True
         >>> User.registered("Guido van Rossum")
         False
+        >>> User.registered(email="username@domain.org")
+        True
         """
-        if any(usr['username'] == username for usr in cls.getall().values()):
-            return True
-        return False
+        if username is not None:
+            kwargs['username'] = username
+        return any(cls.lookup(field, value) is not None
+                   for field, value in kwargs.items())
 
     @classmethod
     def change_db(cls, dbname):
         """Internally sets the name of the database to use"""
         setattr(cls, 'db', staticmethod(lambda: Db(dbname)))
+        setattr(cls, 'dbpath', staticmethod(lambda: dbname))
+
+class Users(Mapping):
+    """A lazy, read-only mapping of uid -> User over a User store.
+    Records are read and hydrated into User objects one at a time, as
+    they are accessed or iterated over, rather than all up front.
+    """
+
+    def __init__(self, cls=User, safe=False):
+        self._cls = cls
+        self._safe = safe
+        self._store = cls.store()
+
+    def _hydrate(self, uid, usr):
+        return self._cls(uid, user=(usr if not self._safe else
+                                    self._cls._publishable(usr)))
+
+    def __getitem__(self, uid):
+        usr = self._store.get(uid)
+        if usr is None:
+            raise KeyError(uid)
+        return self._hydrate(uid, usr)
+
+    def __contains__(self, uid):
+        return self._store.has(uid)
+
+    def __iter__(self):
+        return self._store.iterkeys()
+
+    def __len__(self):
+        return len(self._store)
+
+    def iteritems(self):
+        for uid, usr in self._store.iteritems():
+            yield uid, self._hydrate(uid, usr)
+
+    def itervalues(self):
+        for _, usr in self.iteritems():
+            yield usr
+
+    def items(self):
+        return list(self.iteritems())
+
+    def values(self):
+        return list(self.itervalues())
+
+    def __repr__(self):
+        return '<Users %s>' % self.keys()
+
+def current_user(key='email', cls=User):
+    """Returns the User logged in to this request's session (the one
+    whose id is session()[key]), or None. The user is read at most
+    once per request and kept on web.ctx, so that decorators,
+    handlers and templates may each call current_user() without
+    re-reading the users store; set User.cache_ttl to also reuse it
+    across requests for that many seconds (see User.cached).
+
+    usage:
+    >>> user = waltz.current_user()
+    >>> user.email if user else 'anonymous'
+    """
+    sess = session()
+    uid = sess.get(key) if sess is not None else None
+    memo = web.ctx.get('waltz_user')
+    if memo is None or memo[0] != (cls, uid):
+        memo = web.ctx.waltz_user = (cls, uid), cls.cached(uid)
+    return memo[1]
@@ -0,0 +1,432 @@
+#-*- coding: utf-8 -*-
+
+"""
+    analytics
+    ~~~~~~~~~
+    Write-behind pipeline for the @track decorator. Requests hand
+    their events to a Sink, which buffers them in a bounded queue; a
+    background writer thread appends them in batches to a Log of
+    size-rotated segment files, so no request waits on a disk write
+    and reading history never requires loading all of it. As batches
+    are written, hit counts per minute, route, method and status are
+    rolled up so that dashboards needn't scan raw events (see Rollups).
+
+    Events are compact tuples holding only the fields named in the
+    sink's schema, in schema order. The schema is a whitelist of
+    names from FIELDS (SCHEMA by default); custom fields can be added
+    to FIELDS as functions of a Storage with items env (the WSGI
+    environ), status (e.g. '200 OK'), start (epoch) and latency (ms).
+
+    usage:
+    >>> from waltz import analytics
+    >>> analytics.FIELDS['host'] = lambda hit: hit.env.get('HTTP_HOST')
+    >>> s = analytics.sink('/path/to/db', batch=500, interval=2.0,
+    ...                    fields=('time', 'path', 'status', 'host'))
+    >>> s.emit(s.event(web.ctx, start))
+    >>> s.stats
+    <Counter {'emitted': 1}>
+"""
+
+import os
+import time
+import json
+import errno
+import atexit
+import threading
+import Queue
+from waltz import logger
+from store import RecordStore, filelock
+from utils import Counter, Storage
+
+FIELDS = {
+    'time': lambda hit: round(hit.start, 3),
+    'path': lambda hit: hit.env.get('PATH_INFO'),
+    'query': lambda hit: hit.env.get('QUERY_STRING') or None,
+    'method': lambda hit: hit.env.get('REQUEST_METHOD'),
+    'status': lambda hit: int(hit.status[:3]),
+    'agent': lambda hit: hit.env.get('HTTP_USER_AGENT'),
+    'referrer': lambda hit: hit.env.get('HTTP_REFERER'),
+    'ip': lambda hit: hit.env.get('REMOTE_ADDR'),
+    'latency': lambda hit: round(hit.latency, 2)
+    }
+
+SCHEMA = ('time', 'path', 'method', 'status', 'agent', 'referrer',
+          'latency')
+
+_stop = object()
+
+class Log(object):
+    """An append-only log of analytics events kept as JSON lines in
+    segment files, named after the (ms epoch) time they were started:
+
+        <path>/<13 digit ms epoch>.jsonl
+
+    The first line of each segment is a header, {"fields": [...]},
+    naming the values of every event line (a JSON array) after it. A
+    new segment is started once the current one reaches
+    segment_size bytes, or when the schema changes. If keep is given,
+    only the newest keep segments are retained.
+    """
+
+    # max seconds between an event's time and it being written
+    # (see Sink.interval); bounds how far reads scan past 'until'
+    lateness = 300
+
+    def __init__(self, path, segment_size=16 * 1024 * 1024, keep=None):
+        self.path = path
+        self.segment_size = segment_size
+        self.keep = keep
+
+    def segments(self):
+        """Lists segment file names, oldest first"""
+        try:
+            return sorted(f for f in os.listdir(self.path)
+                          if f.endswith('.jsonl'))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return []
+
+    def _header(self, segment):
+        with open(os.path.join(self.path, segment)) as f:
+            return tuple(json.loads(f.readline())['fields'])
+
+    def _start(self, fields, after=None):
+        """Creates and returns a new segment with header fields"""
+        start = int(time.time() * 1000)
+        if after is not None:
+            start = max(start, int(after[:-len('.jsonl')]) + 1)
+        segment = '%013d.jsonl' % start
+        with open(os.path.join(self.path, segment), 'w') as f:
+            f.write(json.dumps({'fields': fields}) + '\n')
+        segments = self.segments()
+        if self.keep and len(segments) > self.keep:
+            for old in segments[:-self.keep]:
+                os.remove(os.path.join(self.path, old))
+        return segment
+
+    def append(self, fields, events):
+        """Appends events (tuples of values for fields) to the current
+        segment, rotating as needed. Returns the number of events
+        written; events which can't be encoded as JSON are skipped.
+        """
+        fields = list(fields)
+        lines = []
+        for event in events:
+            try:
+                lines.append(json.dumps(list(event)) + '\n')
+            except (TypeError, ValueError, UnicodeDecodeError):
+                pass
+        if not os.path.isdir(self.path):
+            try:
+                os.makedirs(self.path)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        with filelock(os.path.join(self.path, '.lock')):
+            segments = self.segments()
+            segment = segments[-1] if segments else None
+            if segment is None or \
+                    list(self._header(segment)) != fields or \
+                    os.path.getsize(os.path.join(self.path, segment)) \
+                    >= self.segment_size:
+                segment = self._start(fields, after=segment)
+            with open(os.path.join(self.path, segment), 'a') as f:
+                f.write(''.join(lines))
+        return len(lines)
+
+    def read(self, since=None, until=None, limit=None):
+        """Lazily yields events as dicts, oldest first, streaming one
+        segment line at a time. since and until (epoch seconds) filter
+        on the 'time' field and are ignored if the schema lacks it;
+        segments which can't hold matching events aren't opened.
+        """
+        segments = self.segments()
+        starts = [int(s[:-len('.jsonl')]) / 1000.0 for s in segments]
+        count = 0
+        for n, segment in enumerate(segments):
+            if since is not None and n + 1 < len(starts) and \
+                    starts[n + 1] <= since:
+                continue
+            if until is not None and starts[n] > until + self.lateness:
+                return
+            try:
+                f = open(os.path.join(self.path, segment))
+            except IOError as e:
+                # rotated away since it was listed
+                if e.errno != errno.ENOENT:
+                    raise
+                continue
+            with f:
+                fields = json.loads(f.readline())['fields']
+                timed = 'time' in fields
+                for line in f:
+                    if not line.endswith('\n'):
+                        # partially appended
+                        break
+                    event = dict(zip(fields, json.loads(line)))
+                    if timed and (since is not None and
+                                  event['time'] < since or
+                                  until is not None and
+                                  event['time'] > until):
+                        continue
+                    yield event
+                    count += 1
+                    if limit is not None and count >= limit:
+                        return
+
+class Rollups(object):
+    """Hit counts pre-aggregated per minute bucket, kept in a
+    RecordStore with one record per minute: a dict of
+    (path, method, status) -> hits. Counts are merged in as each
+    batch of events is written, and minutes older than retention are
+    pruned, so queries cost O(buckets) rather than O(events).
+    """
+
+    keys = ('path', 'method', 'status')
+
+    def __init__(self, path, retention=24 * 60):
+        self.store = RecordStore(path)
+        self.retention = retention
+        self._pruned = None
+
+    def add(self, fields, events):
+        """Counts events (tuples of values for fields) into their
+        minute buckets
+        """
+        fields = list(fields)
+        index = [fields.index(k) if k in fields else None
+                 for k in self.keys]
+        at = fields.index('time') if 'time' in fields else None
+        now = time.time()
+        oldest = int(now // 60) - self.retention
+        minutes = {}
+        for event in events:
+            minute = int((event[at] if at is not None else now) // 60)
+            if minute < oldest:
+                continue
+            key = tuple(event[i] if i is not None else None
+                        for i in index)
+            minutes.setdefault(minute, Counter()).add(key)
+        for minute, hits in minutes.items():
+            self.store.update(str(minute),
+                              lambda bucket: self._merge(bucket, hits), {})
+        self.prune(oldest)
+
+    @staticmethod
+    def _merge(bucket, hits):
+        for key, n in hits.items():
+            bucket[key] = bucket.get(key, 0) + n
+        return bucket
+
+    def prune(self, before):
+        """Deletes the buckets of minutes before the minute before"""
+        if self._pruned is None:
+            stale = [m for m in self.store.iterkeys() if int(m) < before]
+        else:
+            stale = [str(m) for m in xrange(self._pruned, before)]
+        for minute in stale:
+            self.store.delete(minute)
+        self._pruned = before if self._pruned is None \
+            else max(before, self._pruned)
+
+    def query(self, since, until, by=('path',), **match):
+        """Sums hits in the minutes from since to until (epoch
+        seconds) grouped by the fields in by (any of 'minute', 'path',
+        'method' and 'status'). Only hits whose fields equal those in
+        **match are counted. Returns a list of dicts sorted by hits,
+        each holding the grouped fields and 'hits'.
+
+        The range is clamped to the retained minutes, so a query costs
+        at most O(retention) however wide the range asked for.
+        """
+        now = int(time.time() // 60)
+        first = max(int(since // 60), now - self.retention)
+        last = min(int(until // 60), now)
+        totals = {}
+        for minute in xrange(first, last + 1):
+            for key, n in self.store.get(str(minute), {}).iteritems():
+                hit = dict(zip(self.keys, key), minute=minute * 60)
+                if any(hit[k] != v for k, v in match.items()):
+                    continue
+                group = tuple(hit[k] for k in by)
+                totals[group] = totals.get(group, 0) + n
+        return sorted((dict(zip(by, group), hits=n)
+                       for group, n in totals.iteritems()),
+                      key=lambda row: row['hits'], reverse=True)
+
+class Sink(object):
+    """Buffers analytics events and appends them to a Log at
+    <db>.analytics from a background thread.
+
+    params:
+        db - path of the waltz LazyDB
+        batch - max number of events written per batch
+        interval - max seconds an event waits before its batch is
+                   flushed, however small the batch
+        maxsize - max number of buffered events
+        wait - seconds emit() may block waiting for room in a full
+               buffer (backpressure) before dropping the event. The
+               default, 0, drops immediately.
+        logpath - where to log write errors
+        fields - the event schema; a sequence of names from FIELDS
+        segment_size - bytes after which log segments are rotated
+        keep - number of log segments to retain (default: all)
+        retention - minutes of Rollups to retain; None disables them
+
+    Counts of emitted, dropped and written events, batches and write
+    errors are kept in Sink.stats.
+    """
+
+    def __init__(self, db, batch=100, interval=1.0, maxsize=10000,
+                 wait=0, logpath=None, fields=SCHEMA,
+                 segment_size=16 * 1024 * 1024, keep=None,
+                 retention=24 * 60):
+        unknown = [f for f in fields if f not in FIELDS]
+        if unknown:
+            raise ValueError("Unknown analytics fields: %s" % unknown)
+        self.db = db
+        self.log = Log(db + '.analytics', segment_size=segment_size,
+                       keep=keep)
+        self.rollups = Rollups(db + '.rollups', retention) \
+            if retention else None
+        self.fields = tuple(fields)
+        self.batch = batch
+        self.interval = interval
+        self.maxsize = maxsize
+        self.wait = wait
+        self.logpath = logpath
+        self.stats = Counter()
+        self._lock = threading.Lock()
+        self._pid = None
+        self._writer = None
+        self.queue = None
+        atexit.register(self.close)
+
+    def _count(self, key, n=1):
+        with self._lock:
+            self.stats[key] = self.stats.get(key, 0) + n
+
+    def _start(self):
+        """(Re)starts the writer thread, lazily and once per process:
+        a forked WSGI worker inherits neither the parent's thread nor
+        (sensibly) its buffered events.
+        """
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self.queue = Queue.Queue(self.maxsize)
+            self._writer = threading.Thread(target=self._run,
+                                            name='waltz-analytics')
+            self._writer.daemon = True
+            self._writer.start()
+            self._pid = os.getpid()
+
+    def event(self, ctx, start, status=None):
+        """Builds the schema tuple for a request given its web.ctx and
+        the time at which handling began
+        """
+        hit = Storage(env=ctx.env, status=status or ctx.status,
+                      start=start, latency=(time.time() - start) * 1000)
+        return tuple(FIELDS[f](hit) for f in self.fields)
+
+    def emit(self, event):
+        """Buffers event for writing. Never touches the disk."""
+        if self._pid != os.getpid():
+            self._start()
+        try:
+            if self.wait:
+                self.queue.put(event, timeout=self.wait)
+            else:
+                self.queue.put_nowait(event)
+            self._count('emitted')
+        except Queue.Full:
+            self._count('dropped')
+
+    def _run(self):
+        queue = self.queue
+        while True:
+            events = self._drain(queue)
+            stop = _stop in events
+            events = [e for e in events if e is not _stop]
+            if events:
+                self.write(events)
+            if stop:
+                return
+
+    def _drain(self, queue, block=True):
+        """Collects up to self.batch events, waiting at most
+        self.interval after the first one arrives
+        """
+        events = []
+        deadline = None
+        while len(events) < self.batch:
+            try:
+                if not block:
+                    events.append(queue.get_nowait())
+                    continue
+                timeout = self.interval if deadline is None \
+                    else deadline - time.time()
+                if timeout <= 0:
+                    break
+                events.append(queue.get(timeout=timeout))
+            except Queue.Empty:
+                break
+            if events[-1] is _stop:
+                break
+            if deadline is None:
+                deadline = time.time() + self.interval
+        return events
+
+    def write(self, events):
+        """Appends a batch of events to the log in a single write"""
+        try:
+            written = self.log.append(self.fields, events)
+            if self.rollups:
+                self.rollups.add(self.fields, events)
+            self._count('written', written)
+            self._count('dropped', len(events) - written)
+            self._count('batches')
+        except Exception as e:
+            self._count('errors')
+            self._count('dropped', len(events))
+            if self.logpath:
+                logger(self.logpath, "Analytics write failed: %s" % e,
+                       method='error')
+
+    def flush(self):
+        """Synchronously writes any buffered events"""
+        if self._pid != os.getpid():
+            return
+        while True:
+            events = self._drain(self.queue, block=False)
+            events = [e for e in events if e is not _stop]
+            if not events:
+                break
+            self.write(events)
+
+    def close(self, timeout=5):
+        """Stops the writer thread once it has written what it holds,
+        then flushes whatever remains. Called at exit.
+        """
+        if self._pid != os.getpid():
+            return
+        try:
+            self.queue.put(_stop, timeout=timeout)
+        except Queue.Full:
+            pass
+        self._writer.join(timeout)
+        self.flush()
+        self._pid = None
+
+_sinks = {}
+_sinks_lock = threading.Lock()
+
+def sink(db, **kwargs):
+    """Returns the process-wide Sink for the db at path db, creating
+    it with **kwargs (see Sink) if it doesn't yet exist
+    """
+    with _sinks_lock:
+        if db not in _sinks:
+            _sinks[db] = Sink(db, **kwargs)
+        return _sinks[db]
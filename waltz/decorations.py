@@ -10,13 +10,12 @@
 """
 
 import os
+import math
 import random
 import time
 import json
-import cPickle
-from copy import copy
-from lazydb import Db
-from waltz import web, session, log
+from waltz import web, session, analytics, metrics
+from ratelimit import Limiter
 
 def track(fn):
     """A decorator which wraps each route with analytics tracking."""
@@ -27,20 +26,26 @@ def track(fn):
         self - methods(self).
         """        
         def inner(*args, **kwargs):
-            """Copy web context environment, clean it to avoid
-            pickeling issues, and dump it to lazydb before returning
-            the route
+            """Time the route and, once it has returned (or raised),
+            hand an event holding the fields of the app's analytics
+            schema to its sink, which writes it to lazydb in the
+            background
             """
-            ctx = copy(web.ctx['env'])
-            del ctx['wsgi.errors']
-            del ctx['wsgi.input']
+            waltz = web.ctx['waltz']
+            sink = waltz.get('analytics') or analytics.sink(waltz['db'])
+            start = time.time()
+            status = '500'
             try:
-                Db(web.ctx['waltz']['db']).append('analytics', ctx)
-            except cPickle.UnpicklingError as e:
-                log("Analytics tracking error", lbl="error")
-                raise Exception("Database Connection Error: "\
-                                    "web.ctx incorrecly configured.")
-            return fn(*args, **kwargs)        
+                result = fn(*args, **kwargs)
+                status = None
+                return result
+            except web.HTTPError:
+                # redirects, notfound, etc. have set web.ctx.status
+                status = None
+                raise
+            finally:
+                with metrics.timed('waltz_track_seconds'):
+                    sink.emit(sink.event(web.ctx, start, status=status))
         return inner
     return tracked(fn)
 
@@ -100,6 +105,50 @@ def require_loggedin(web, redir, key='logged', value=True):
         return inner
     return decorator
 
+def throttle(ip=None, account=None, field='email'):
+    """Returns a decorator which refuses requests with 429 Too Many
+    Requests (and a Retry-After header) once the client's IP, or the
+    account named by the request's input field, has used up its
+    token bucket (see waltz.ratelimit) -- before the route does any
+    storage or hashing work.
+
+    params:
+        ip - a waltz.ratelimit.Limiter of requests per client IP; by
+             default, bursts of 20 refilled at 1 per second
+        account - a Limiter of requests per account; by default,
+                  bursts of 10 refilled at 1 per minute
+        field - the web.input() field naming the account
+
+    Pass ip=False or account=False to not limit by either.
+
+    usage:
+    >>> class Login:
+    ...     @throttle()
+    ...     def POST(self):
+    ...         ...
+    """
+    if ip is None:
+        ip = Limiter(rate=1, burst=20)
+    if account is None:
+        account = Limiter(rate=1 / 60.0, burst=10)
+    def decorator(f):
+        def inner(*args, **kwargs):
+            limits = [('ip', ip, web.ctx.ip)]
+            name = web.input(**{field: ''})[field].strip().lower()
+            if name:
+                limits.append(('account', account, name))
+            for limit, limiter, key in limits:
+                if limiter is not False and not limiter.allow(key):
+                    metrics.inc('waltz_throttled_total', limit=limit)
+                    retry = int(math.ceil(limiter.retry_after(key)))
+                    raise web.HTTPError('429 Too Many Requests',
+                                        {'Retry-After': str(retry)},
+                                        'Too many requests, retry in '
+                                        '%s seconds' % retry)
+            return f(*args, **kwargs)
+        return inner
+    return decorator
+
 def API(web):
     def decorator(f):
         def inner(*args, **kwargs):
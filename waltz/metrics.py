@@ -0,0 +1,196 @@
+#-*- coding: utf-8 -*-
+
+"""
+    metrics
+    ~~~~~~~
+    Opt-in, in-process instrumentation: counters, gauges and latency
+    histograms, keyed by name and labels, plus exporters which render
+    them as text. Instrumentation is off (and all of it a no-op)
+    until enabled, e.g. by waltz.setup.dancefloor(instrument=True).
+
+    usage:
+    >>> from waltz import metrics
+    >>> metrics.registry.enabled = True
+    >>> with metrics.timed('waltz_render_seconds', template='index'):
+    ...     render().index()
+    >>> print metrics.export('prometheus')
+"""
+
+import time
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+
+# upper bounds (in seconds) of latency histogram buckets
+BUCKETS = (.001, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+class Histogram(object):
+    """Counts observations into buckets with the upper bounds given
+    (plus one unbounded bucket), keeping their sum and count
+    """
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """Estimates the q quantile as the upper bound of the bucket
+        it falls in (None if that is the unbounded bucket)
+        """
+        rank, seen = q * self.count, 0
+        for bound, n in zip(self.buckets, self.counts):
+            seen += n
+            if seen >= rank:
+                return bound
+        return None
+
+class Registry(object):
+    """Holds every metric, keyed by (name, labels)"""
+
+    def __init__(self):
+        self.enabled = False
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, n=1, **labels):
+        """Adds n to a counter"""
+        if self.enabled:
+            key = self._key(name, labels)
+            with self._lock:
+                self.counters[key] = self.counters.get(key, 0) + n
+
+    def gauge(self, name, delta, **labels):
+        """Adds delta (which may be negative) to a gauge"""
+        if self.enabled:
+            key = self._key(name, labels)
+            with self._lock:
+                self.gauges[key] = self.gauges.get(key, 0) + delta
+
+    def observe(self, name, value, **labels):
+        """Records value in a histogram"""
+        if self.enabled:
+            key = self._key(name, labels)
+            with self._lock:
+                if key not in self.histograms:
+                    self.histograms[key] = Histogram()
+                self.histograms[key].observe(value)
+
+    @contextmanager
+    def timed(self, name, **labels):
+        """Records the seconds spent in the with block in histogram
+        name
+        """
+        if not self.enabled:
+            yield
+            return
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start, **labels)
+
+    def clear(self):
+        with self._lock:
+            self.counters.clear()
+            self.gauges.clear()
+            self.histograms.clear()
+
+registry = Registry()
+inc = registry.inc
+gauge = registry.gauge
+observe = registry.observe
+timed = registry.timed
+
+class TimedRender(object):
+    """Wraps a web.template.render object, recording the time taken
+    to render each template in histogram name
+    """
+
+    def __init__(self, render, name='waltz_render_seconds'):
+        self._render = render
+        self._name = name
+
+    def __getattr__(self, template):
+        fn = getattr(self._render, template)
+        def timed_template(*args, **kwargs):
+            with timed(self._name, template=template):
+                return fn(*args, **kwargs)
+        return timed_template
+
+    def cached(self, *args, **kwargs):
+        """Like the wrapped render's cached(), timing cache misses"""
+        return self._render.cached(*args, render=self, **kwargs)
+
+    def stream(self, *args, **kwargs):
+        return self._render.stream(*args, **kwargs)
+
+def _labels(labels, **extra):
+    labels = list(labels) + sorted(extra.items())
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('"', '\\"'))
+                             for k, v in labels)
+
+def prometheus(registry=registry):
+    """Renders metrics in the Prometheus text exposition format"""
+    lines = []
+    with registry._lock:
+        for kind, metrics in [('counter', registry.counters),
+                              ('gauge', registry.gauges)]:
+            for name in sorted(set(n for n, _ in metrics)):
+                lines.append('# TYPE %s %s' % (name, kind))
+                for (n, labels), value in sorted(metrics.items()):
+                    if n == name:
+                        lines.append('%s%s %s' % (name, _labels(labels),
+                                                  value))
+        for name in sorted(set(n for n, _ in registry.histograms)):
+            lines.append('# TYPE %s histogram' % name)
+            for (n, labels), h in sorted(registry.histograms.items()):
+                if n != name:
+                    continue
+                seen = 0
+                for bound, count in zip(h.buckets + ('+Inf',), h.counts):
+                    seen += count
+                    lines.append('%s_bucket%s %s' % (
+                            name, _labels(labels, le=bound), seen))
+                lines.append('%s_sum%s %s' % (name, _labels(labels), h.sum))
+                lines.append('%s_count%s %s' % (name, _labels(labels),
+                                                h.count))
+    return '\n'.join(lines) + '\n'
+
+def text(registry=registry):
+    """Renders metrics as human readable text, summarizing each
+    histogram by its count, mean and estimated p50, p90 and p99
+    """
+    ms = lambda s: '%.1fms' % (s * 1000) if s is not None else 'inf'
+    lines = []
+    with registry._lock:
+        for (name, labels), value in sorted(registry.counters.items() +
+                                            registry.gauges.items()):
+            lines.append('%s%s %s' % (name, _labels(labels), value))
+        for (name, labels), h in sorted(registry.histograms.items()):
+            lines.append('%s%s count=%s mean=%s p50<=%s p90<=%s p99<=%s' % (
+                    name, _labels(labels), h.count,
+                    ms(h.sum / h.count if h.count else 0),
+                    ms(h.quantile(.5)), ms(h.quantile(.9)),
+                    ms(h.quantile(.99))))
+    return '\n'.join(lines) + '\n'
+
+# exporters by format name; register your own as func(registry) -> str
+exporters = {'text': text, 'prometheus': prometheus}
+
+def export(fmt='text', registry=registry):
+    return exporters[fmt](registry)
@@ -4,29 +4,397 @@
    Modules/plugins + extras for the waltz framework
 """
 
-from waltz import web, db
+import os
+import sys
+import json
+import time
+import email.utils
+import hashlib
+import calendar
+import threading
+from itertools import chain, islice
+from waltz import web, analytics, metrics
 from datetime import datetime     
 from lazydb import Db
+from utils import group, Counter
+from rendering import CHUNK_SIZE, chunks, parts
 
 class Analytics:
     def GET(self):
+        """Streams tracked events, oldest first, as JSON lines (one
+        object per event, keyed by analytics schema field), so memory
+        use doesn't grow with history.
+
+        params:
+            since, until - epoch seconds bounding event times
+            limit - max number of events to return
+        """
+        i = web.input(since=None, until=None, limit=None)
+        try:
+            since, until = [float(t) if t else None
+                            for t in (i.since, i.until)]
+            limit = int(i.limit) if i.limit else None
+        except ValueError:
+            raise web.badrequest()
+        waltz = web.ctx['waltz']
+        sink = waltz.get('analytics') or analytics.sink(waltz['db'])
+        events = sink.log.read(since=since, until=until, limit=limit)
+        web.header('Content-Type', 'application/x-ndjson')
+        return (''.join(json.dumps(e) + '\n' for e in chunk)
+                for chunk in group(events, 100))
+
+class Rollups:
+    def GET(self):
+        """Returns pre-aggregated hit counts as json, answering in
+        O(minute buckets) however many events were tracked.
+
+        params:
+            since, until - epoch seconds (default: the last hour)
+            by - comma separated fields to group hits by, of minute,
+                 path, method and status (default: path)
+            path, method, status - only count hits matching these
+        """
+        i = web.input(since=None, until=None, by='path',
+                      path=None, method=None, status=None)
+        match = dict((k, i[k]) for k in analytics.Rollups.keys
+                     if i[k] is not None)
+        by = tuple(f for f in i.by.split(',') if f)
+        try:
+            until = float(i.until) if i.until else time.time()
+            since = float(i.since) if i.since else until - 3600
+            if 'status' in match:
+                match['status'] = int(match['status'])
+        except ValueError:
+            raise web.badrequest()
+        if not set(by) <= set(('minute',) + analytics.Rollups.keys):
+            raise web.badrequest()
+        waltz = web.ctx['waltz']
+        sink = waltz.get('analytics') or analytics.sink(waltz['db'])
+        if not sink.rollups:
+            raise web.notfound()
         web.header('Content-Type', 'application/json')
-        return db().get('analytics')
+        return json.dumps({'since': since, 'until': until,
+                           'hits': sink.rollups.query(since, until, by=by,
+                                                      **match)})
+
+class Metrics:
+    def GET(self):
+        """Exports the metrics recorded when waltz is set up with
+        dancefloor(instrument=True) as text, in the format named by
+        the format param: text (default), prometheus or any exporter
+        registered in waltz.metrics.exporters
+        """
+        i = web.input(format='text')
+        if not metrics.registry.enabled:
+            raise web.notfound()
+        if i.format not in metrics.exporters:
+            raise web.badrequest()
+        content_type = 'text/plain; version=0.0.4' \
+            if i.format == 'prometheus' else 'text/plain'
+        web.header('Content-Type', content_type)
+        return metrics.export(i.format)
+
+class Sampler(object):
+    """A statistical profiler: every interval seconds, records the
+    stack of every thread (other than the sampling one) and counts
+    identical stacks. Only one sampling session runs at a time.
+    """
+
+    max_seconds = 30
+    min_interval = 0.001
+    max_depth = 128
+    _running = threading.Lock()
+
+    def __init__(self, interval=0.005):
+        self.interval = max(interval, self.min_interval)
+
+    @staticmethod
+    def _frame(frame):
+        code = frame.f_code
+        return '%s (%s:%s)' % (code.co_name,
+                               os.path.basename(code.co_filename),
+                               code.co_firstlineno)
+
+    def sample(self, seconds):
+        """Samples for seconds (at most max_seconds) and returns a
+        Counter of stacks (root first, as tuples of frame names).
+        Returns None if another session is already running.
+        """
+        if not self._running.acquire(False):
+            return None
+        try:
+            stacks = Counter()
+            me = threading.current_thread().ident
+            deadline = time.time() + min(seconds, self.max_seconds)
+            while time.time() < deadline:
+                for thread, frame in sys._current_frames().items():
+                    if thread == me:
+                        continue
+                    stack = []
+                    while frame is not None and len(stack) < self.max_depth:
+                        stack.append(self._frame(frame))
+                        frame = frame.f_back
+                    stacks.add(tuple(reversed(stack)))
+                time.sleep(self.interval)
+            return stacks
+        finally:
+            self._running.release()
+
+    @staticmethod
+    def collapsed(stacks):
+        """Folds stacks into the collapsed format read by flamegraph
+        tools: one 'root;...;leaf count' line per distinct stack
+        """
+        return ''.join('%s %s\n' % (';'.join(stack), n)
+                       for stack, n in stacks.sorted_items())
 
-def rss(items_func, template=None, **kwargs):
-    rss = RSS(template=template, **kwargs)
+    @staticmethod
+    def top(stacks):
+        """Lists frames by the share of samples in which each was on
+        top of the stack (self time)
+        """
+        leaves = Counter()
+        for stack, n in stacks.iteritems():
+            leaves[stack[-1]] = leaves.get(stack[-1], 0) + n
+        total = float(sum(leaves.values())) or 1
+        return ''.join('%5.1f%% %6d  %s\n' % (100 * n / total, n, frame)
+                       for frame, n in leaves.sorted_items())
+
+class Profiler:
+    def GET(self):
+        """Samples the stacks of this worker's threads for a few
+        seconds and returns them aggregated as text. Disabled (404)
+        unless waltz is set up with dancefloor(profiler=True); only
+        one session runs at a time (409 while busy) and sessions are
+        capped at Sampler.max_seconds.
+
+        params:
+            seconds - how long to sample (default 5)
+            interval - seconds between samples (default 0.005)
+            format - collapsed (default; flamegraph-ready) or top
+        """
+        if not web.ctx['waltz'].get('profiler'):
+            raise web.notfound()
+        i = web.input(seconds='5', interval='0.005', format='collapsed')
+        if i.format not in ('collapsed', 'top'):
+            raise web.badrequest()
+        try:
+            seconds, interval = float(i.seconds), float(i.interval)
+        except ValueError:
+            raise web.badrequest()
+        stacks = Sampler(interval).sample(seconds)
+        if stacks is None:
+            raise web.conflict()
+        web.header('Content-Type', 'text/plain')
+        return getattr(Sampler, i.format)(stacks)
+
+def _timestamp(date):
+    """Returns an item's date -- a datetime (naive ones taken as
+    UTC), epoch seconds or an RFC 822 date string -- in epoch
+    seconds, or None if it has none
+    """
+    if isinstance(date, datetime):
+        return calendar.timegm(date.utctimetuple())
+    if isinstance(date, (int, long, float)):
+        return date
+    if isinstance(date, basestring):
+        parsed = email.utils.parsedate_tz(date)
+        if parsed:
+            return email.utils.mktime_tz(parsed)
+    return None
+
+def _rfc822(date):
+    """Formats an item's date (see _timestamp) as RFC 822 requires;
+    dates which can't be parsed are returned as they are
+    """
+    timestamp = _timestamp(date)
+    if timestamp is None:
+        return date or ''
+    return email.utils.formatdate(timestamp, usegmt=True)
+
+def _rfc3339(date):
+    """Formats an item's date (see _timestamp) as Atom and JSON Feed
+    require; dates which can't be parsed are returned as they are
+    """
+    timestamp = _timestamp(date)
+    if timestamp is None:
+        return date or ''
+    return datetime.utcfromtimestamp(timestamp).strftime(
+        '%Y-%m-%dT%H:%M:%SZ')
+
+def _conditional(etag, modified):
+    """Sets the ETag and Last-Modified (epoch seconds) headers, and
+    raises 304 Not Modified if the client already has this version.
+    If-None-Match, when sent, takes precedence over If-Modified-Since.
+    """
+    env = web.ctx.env
+    web.header('ETag', '"%s"' % etag)
+    if modified:
+        web.lastmodified(datetime.utcfromtimestamp(modified))
+    if 'HTTP_IF_NONE_MATCH' in env:
+        tags = [t.strip().split('W/', 1)[-1].strip('"')
+                for t in env['HTTP_IF_NONE_MATCH'].split(',')]
+        current = etag in tags or '*' in tags
+    else:
+        since = web.parsehttpdate(
+            env.get('HTTP_IF_MODIFIED_SINCE', '').split(';')[0])
+        current = bool(modified and since and
+                       calendar.timegm(since.timetuple()) >= int(modified))
+    if current:
+        raise web.notmodified()
+
+# media types clients may Accept, by the feed format they denote
+MEDIA_TYPES = {'application/rss+xml': 'rss',
+               'application/atom+xml': 'atom',
+               'application/feed+json': 'json',
+               'application/json': 'json'}
+
+def _negotiate(formats, default='rss'):
+    """Returns the feed format the client asked for, by ?format= or
+    else its Accept header (honouring q values), or default
+    """
+    fmt = web.input(format=None).format
+    if fmt:
+        if fmt not in formats:
+            raise web.notfound()
+        return fmt
+    ranked = []
+    for n, media in enumerate(web.ctx.env.get('HTTP_ACCEPT', '').split(',')):
+        media = media.split(';')
+        q = 1.0
+        for param in media[1:]:
+            key, _, value = param.strip().partition('=')
+            if key == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0
+        ranked.append((q, -n, media[0].strip().lower()))
+    for q, _, media in sorted(ranked, reverse=True):
+        if q > 0 and MEDIA_TYPES.get(media) in formats:
+            return MEDIA_TYPES[media]
+    return default
+
+def rss(items_func, template=None, limit=50, ttl=0, formats=None,
+        **kwargs):
+    """Returns a web.py class serving the feed of the first limit
+    items from items_func() (see RSS.feed) as RSS, Atom or JSON Feed,
+    as the client asks by ?format=rss|atom|json or its Accept header
+    (RSS by default). template, if given, is a custom RSS template,
+    and the feed is then only served as RSS unless formats says
+    otherwise; Atom and JSON Feed are only given the kwargs among
+    RSS.options.
+
+    Responses carry an ETag (a fingerprint of the items and format)
+    and, if the items are dated, a Last-Modified date (the latest of
+    their 'updated', else 'date', fields; see Feed.updated), so polls
+    of an unchanged feed get 304 Not Modified. Both are derived from
+    the items alone, so every worker process agrees on them. Edits
+    which don't set an item's 'updated' date, and removals, change
+    the ETag but not Last-Modified, so are only seen by clients which
+    send If-None-Match (as clients given an ETag do). Each format is
+    only rendered when the items change, and items_func is called at
+    most once every ttl seconds.
+    """
+    if formats is None:
+        formats = ('rss',) if template else ('rss', 'atom', 'json')
+    options = dict((k, v) for k, v in kwargs.items() if k in RSS.options)
+    feeds = {'rss': lambda: RSS(template=template, **dict(kwargs)),
+             'atom': lambda: Atom(**dict(options)),
+             'json': lambda: JSONFeed(**dict(options))}
+    feeds = dict((fmt, feeds[fmt]()) for fmt in formats)
 
     class RSSfeed:
+        version = None
+        fetched = 0
+
         def GET(self):
-            web.header('Content-Type', 'application/xml')
-            return rss.feed(items_func())
+            fmt = _negotiate(feeds, default=formats[0])
+            web.header('Content-Type', feeds[fmt].content_type)
+            web.header('Vary', 'Accept')
+            version = RSSfeed.version
+            if version is None or time.time() - RSSfeed.fetched >= ttl:
+                items = list(islice(items_func(), limit))
+                etag = Feed.fingerprint(items)
+                if version is None or version.etag != etag:
+                    version = RSSfeed.version = web.storage(
+                        etag=etag, entries=items, bodies={},
+                        modified=Feed.updated(items))
+                RSSfeed.fetched = time.time()
+            _conditional('%s-%s' % (version.etag, fmt), version.modified)
+            if fmt in version.bodies:
+                return iter(version.bodies[fmt])
+            return self.render(version, fmt)
+
+        def render(self, version, fmt):
+            """Streams the feed, keeping it for later requests"""
+            body = []
+            for chunk in feeds[fmt].stream(version.entries):
+                body.append(chunk)
+                yield chunk
+            version.bodies[fmt] = body
     return RSSfeed
 
-class RSS:
+class Feed(object):
+    """Base of the feed formats (RSS, Atom, JSONFeed), each of which
+    renders lists of item dicts (see RSS.feed) with its stream(items,
+    size), a generator of utf-8 chunks of about size bytes
+    """
 
-    _template = """$def with (title="", link="", description="", \
+    content_type = None
+
+    def feed(self, items):
+        return ''.join(self.stream(items))
+
+    @staticmethod
+    def fingerprint(items):
+        """Returns a digest of items, which changes if they do"""
+        return hashlib.sha1(json.dumps(items, sort_keys=True,
+                                       default=repr)).hexdigest()
+
+    @staticmethod
+    def modified(items):
+        """Returns the date of the newest of items, in epoch seconds,
+        or None if they're undated
+        """
+        dates = [_timestamp(item.get('date')) for item in items]
+        return max([d for d in dates if d is not None] or [None])
+
+    @staticmethod
+    def updated(items):
+        """Returns when the latest of items was last updated (its
+        'updated' date, else its 'date'), in epoch seconds, or None
+        if they're undated
+        """
+        dates = [_timestamp(item.get('updated') or item.get('date'))
+                 for item in items]
+        return max([d for d in dates if d is not None] or [None])
+
+    def _newest(self, items):
+        """Returns (the date of the newest of items, items). If items
+        is an iterator, rather than a list, its first item is taken to
+        be the newest (as feeds list items newest first).
+        """
+        if isinstance(items, (list, tuple)):
+            return self.modified(items), items
+        items = iter(items)
+        first = list(islice(items, 1))
+        return self.modified(first), chain(first, items)
+
+class RSS(Feed):
+
+    content_type = 'application/xml'
+
+    # the channel's options, as accepted by the default templates
+    options = ('title', 'link', 'description', 'language', 'date',
+               'generator', 'editor', 'webmaster')
+
+    # the default feed is rendered in three parts, so items can be
+    # rendered (and streamed) one at a time and the channel header
+    # rendered just once
+    _channel = """$def with (title="", link="", description="", \
  language="en-us", date="", generator="", \
- editor="", webmaster="", items=[])
+ editor="", webmaster="")
 
 <!--?xml version="1.0"?-->
 <rss version="2.0">
@@ -42,33 +410,49 @@ class RSS:
       <managingeditor>$editor</managingeditor>
       <webmaster>$webmaster</webmaster>
 
-      $for item in items:
+"""
+    _item = """$def with (item, date)
         <item>
            <title>$(item['title'] if 'title' in item else '')</title>
            <link>$(item['link'] if  'link' in item else '')</link>
            <description><!--[CDATA[$(item['description'][:100] if 'description' in item else '')..]]--></description>
-           <pubdate>$(item['date'] if 'date' in item else '')</pubdate>
-           <guid>$(item['guid'] if 'guild' in item else '')</guid>
+           <pubdate>$date</pubdate>
+           <guid>$(item['guid'] if 'guid' in item else '')</guid>
         </item>
-    </channel>
+"""
+    _footer = """    </channel>
 </rss>
 """
+    # stands in for the feed's date in the pre-rendered channel header
+    _date = u'\x00waltz:date\x00'
+    _filename = '<template>'
+    _datefmt = staticmethod(_rfc822)
+
     def __init__(self, template=None, **kwargs):
-        template = template or self._template
         self.kwargs = kwargs
-        if template == self._template:
-            for (k, v) in [('title', ''),
-                           ('description', ''),
-                           ('language', 'en-us'),
-                           ('date', datetime.now().ctime()),
-                           ('generator', ''),
-                           ('editor', 'waltz'),
-                           ('webmaster', '')]:
-                kwargs.setdefault(k, v)
-        self.template = web.template.Template(template)
+        self.template = None
+        if template:
+            self.template = web.template.Template(template)
+            return
+        for (k, v) in [('title', ''),
+                       ('description', ''),
+                       ('language', 'en-us'),
+                       ('generator', ''),
+                       ('editor', 'waltz'),
+                       ('webmaster', '')]:
+            kwargs.setdefault(k, v)
+        channel = web.template.Template(self._channel,
+                                        filename=self._filename)
+        self.channel = [web.safestr(part) for part in unicode(
+                channel(**dict(kwargs, date=self._date))).split(self._date)]
+        self.item = web.template.Template(self._item,
+                                          filename=self._filename)
 
     def feed(self, items):
-        """Example items list for waltz RSS template:
+        """Renders the feed of items. Unless a date was given, the
+        feed's pubdate and lastbuilddate are the newest item's date.
+
+        Example items list for waltz RSS template:
 
         [{'title': '',
           'link': '',
@@ -79,9 +463,105 @@ class RSS:
           }, ...
         ]
 
+        where an item's date may be a datetime, epoch seconds or an
+        RFC 822 date string.
+
         :param items: a function which generates item dicts of the
                       above format
         """
-        kwargs = {'items': items}
-        kwargs.update(self.kwargs)     
-        return self.template(**kwargs)
+        return Feed.feed(self, items)
+
+    def stream(self, items, size=CHUNK_SIZE):
+        """Renders the feed of items (see feed) as a generator of utf-8
+        chunks of about size bytes, rendering each item only as the
+        previous chunks are consumed. A custom template is rendered
+        whole, but its output is still streamed without joining it.
+
+        If items is an iterator, rather than a list, its first item
+        is taken to be the newest (as feeds list items newest first).
+        """
+        if self.template is not None:
+            return chunks(parts(self.template(items=items, **self.kwargs)),
+                          size)
+        newest, items = self._newest(items)
+        date = self.kwargs.get('date') or self._datefmt(newest or time.time())
+        return chunks(chain([web.safestr(date).join(self.channel)],
+                            (self.item(item, self._datefmt(item.get('date')))
+                             for item in items),
+                            [self._footer]), size)
+
+class Atom(RSS):
+    """The feed as Atom (RFC 4287), from the same items and options
+    as RSS (but for custom templates)
+    """
+
+    content_type = 'application/atom+xml'
+
+    _channel = """$def with (title="", link="", description="", \
+ language="en-us", date="", generator="", \
+ editor="", webmaster="")
+<?xml version="1.0" encoding="utf-8"?>
+<feed xmlns="http://www.w3.org/2005/Atom" xml:lang="$language">
+  <title>$title</title>
+  <link href="$link"/>
+  <id>$(link or title)</id>
+  <subtitle>$description</subtitle>
+  <updated>$date</updated>
+  <author><name>$editor</name></author>
+  <generator>$generator</generator>
+"""
+    _item = """$def with (item, date)
+  <entry>
+    <title>$item.get('title', '')</title>
+    <link href="$item.get('link', '')"/>
+    <id>$(item.get('guid') or item.get('link') or item.get('title', ''))</id>
+    <updated>$date</updated>
+    <summary>$item.get('description', '')</summary>
+  </entry>
+"""
+    _footer = """</feed>
+"""
+    # .xml templates escape their output
+    _filename = 'atom.xml'
+    _datefmt = staticmethod(_rfc3339)
+
+    def __init__(self, **kwargs):
+        RSS.__init__(self, **kwargs)
+
+class JSONFeed(Feed):
+    """The feed as JSON Feed (https://jsonfeed.org/version/1.1), from
+    the same items and options as RSS, serialized directly rather
+    than through a template
+    """
+
+    content_type = 'application/feed+json'
+    version = 'https://jsonfeed.org/version/1.1'
+
+    def __init__(self, **kwargs):
+        self.kwargs = kwargs
+
+    def _item(self, item):
+        entry = {'id': unicode(item.get('guid') or item.get('link') or
+                               item.get('title', '')),
+                 'title': item.get('title', ''),
+                 'content_text': item.get('description', '')}
+        if item.get('link'):
+            entry['url'] = item['link']
+        if item.get('date'):
+            entry['date_published'] = _rfc3339(item['date'])
+        return entry
+
+    def stream(self, items, size=CHUNK_SIZE):
+        feed = {'version': self.version,
+                'title': self.kwargs.get('title', '')}
+        for key, option in [('home_page_url', 'link'),
+                            ('description', 'description'),
+                            ('language', 'language')]:
+            if self.kwargs.get(option):
+                feed[key] = self.kwargs[option]
+        head = json.dumps(feed, sort_keys=True)[:-1] + ', "items": ['
+        return chunks(chain([head],
+                            ((',' if n else '') + json.dumps(self._item(item),
+                                                              sort_keys=True)
+                             for n, item in enumerate(items)),
+                            [']}']), size)
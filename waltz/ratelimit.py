@@ -0,0 +1,81 @@
+#-*- coding: utf-8 -*-
+
+"""
+    ratelimit
+    ~~~~~~~~~
+    In-memory rate limiting by token bucket, e.g. of login attempts
+    per client IP and per account (see waltz.decorations.throttle).
+
+    Each key (an IP, an account name) has a bucket holding up to
+    burst tokens, refilled at rate tokens per second; every request
+    spends a token, and requests finding the bucket empty are
+    refused. Buckets are kept as a (tokens, time) pair per key, in
+    order of last use, and those unused for long enough to have
+    refilled completely -- and so carry no information -- are evicted
+    every interval seconds, so the table only holds keys active in
+    the last burst / rate seconds. The table holds at most maxsize buckets: to
+    stay bounded under a flood of distinct keys (e.g. random account
+    names), the least recently used are dropped, forgetting those
+    keys' spent tokens.
+
+    usage:
+    >>> logins = Limiter(rate=0.1, burst=5)
+    >>> logins.allow('username')
+    True
+"""
+
+import time
+import threading
+from collections import OrderedDict
+
+class Limiter(object):
+    """A table of token buckets, keyed by e.g. client IP"""
+
+    def __init__(self, rate, burst, interval=60, maxsize=100000):
+        self.rate = float(rate)
+        self.burst = burst
+        self.interval = interval
+        self.maxsize = maxsize
+        # key -> (tokens, time tokens were counted), least recent first
+        self.buckets = OrderedDict()
+        self._evicted = time.time()
+        self._lock = threading.Lock()
+
+    def _tokens(self, key, now):
+        tokens, stamp = self.buckets.get(key, (self.burst, now))
+        return min(self.burst, tokens + (now - stamp) * self.rate)
+
+    def allow(self, key, cost=1):
+        """Spends cost tokens from key's bucket, if it holds that
+        many. Returns whether it did.
+        """
+        now = time.time()
+        with self._lock:
+            tokens = self._tokens(key, now)
+            allowed = tokens >= cost
+            self.buckets.pop(key, None)
+            self.buckets[key] = (tokens - cost if allowed else tokens, now)
+            while len(self.buckets) > self.maxsize:
+                self.buckets.popitem(last=False)
+            if now - self._evicted >= self.interval:
+                self._evict(now)
+        return allowed
+
+    def retry_after(self, key, cost=1):
+        """Returns the seconds until key's bucket will hold cost tokens"""
+        with self._lock:
+            tokens = self._tokens(key, time.time())
+        return max(0, (cost - tokens) / self.rate)
+
+    def _evict(self, now):
+        """Drops the buckets unused for long enough to have refilled
+        (called with the lock). As buckets are kept in order of use,
+        only those dropped (and one more) are examined.
+        """
+        refill = self.burst / self.rate
+        while self.buckets:
+            key, (tokens, stamp) = next(self.buckets.iteritems())
+            if now - stamp < refill:
+                break
+            del self.buckets[key]
+        self._evicted = now
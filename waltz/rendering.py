@@ -0,0 +1,386 @@
+#-*- coding: utf-8 -*-
+
+"""
+    rendering
+    ~~~~~~~~~
+    A drop-in replacement for web.template.render which compiles each
+    template at most once per process, rather than once per render
+    object (or, in debug mode, on every lookup).
+
+    Compiled template code is kept in a process-wide cache, shared by
+    every Render (e.g. waltz.render and waltz.slender), and can also
+    be persisted to disk (marshalled, like .pyc files) so that cold
+    worker processes load templates instead of compiling them. Only
+    in debug mode (check=True) are templates checked for changes on
+    every lookup; otherwise they're read once and trusted thereafter.
+
+    Rendered output can be cached too (see Render.cached), in a
+    process-wide LRU cache bounded by the size of its contents, or
+    streamed to the client in chunks (see Render.stream).
+
+    usage:
+    >>> from waltz.rendering import Render
+    >>> render = Render('templates/', base='base', cachedir='.templates')
+    >>> render.precompile()
+    3
+    >>> render.index()
+    >>> render.cached(60, session=('email',)).index()
+    >>> render.stream(css='/static/css/list.css').listing(rows)
+"""
+
+import os
+import imp
+import errno
+import marshal
+import hashlib
+import tempfile
+import time
+import threading
+from collections import OrderedDict
+import web
+import metrics
+from utils import Counter
+
+# compiled code is only valid for this python and web.py
+MAGIC = imp.get_magic() + web.__version__
+
+# bytes of output to gather before yielding a chunk of a stream
+CHUNK_SIZE = 16 * 1024
+
+_codes = {} # abspath -> (mtime, size, code)
+_lock = threading.Lock()
+
+def _cachefile(cachedir, path):
+    return os.path.join(cachedir, hashlib.sha1(path).hexdigest() + '.tplc')
+
+def _load(cachefile, stat):
+    """Returns the code marshalled in cachefile, or None if there is
+    none or it wasn't compiled from the source file with stat
+    """
+    try:
+        with open(cachefile, 'rb') as f:
+            magic, mtime, size, code = marshal.load(f)
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return None
+    except (EOFError, ValueError, TypeError):
+        return None
+    if (magic, mtime, size) == (MAGIC, stat.st_mtime, stat.st_size):
+        return code
+
+def _dump(cachefile, stat, code):
+    cachedir = os.path.dirname(cachefile)
+    if not os.path.isdir(cachedir):
+        try:
+            os.makedirs(cachedir)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+    fd, tmp = tempfile.mkstemp(dir=cachedir, prefix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            marshal.dump((MAGIC, stat.st_mtime, stat.st_size, code), f)
+        os.rename(tmp, cachefile)
+    except:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+def compiled(path, compile, cachedir=None):
+    """Returns (mtime, size, code) for the template at path, where
+    code is compile(text, path) of its normalized text, compiling it
+    only if neither the process nor cachedir (if given) hold code
+    compiled from the file as it is now.
+    """
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    entry = _codes.get(path)
+    if entry is not None and entry[:2] == (stat.st_mtime, stat.st_size):
+        return entry
+    with _lock:
+        code = None
+        if cachedir:
+            cachefile = _cachefile(cachedir, path)
+            code = _load(cachefile, stat)
+        if code is None:
+            with open(path) as f:
+                text = web.template.Template.normalize_text(f.read())
+            code = compile(text, path)
+            if cachedir:
+                _dump(cachefile, stat, code)
+        entry = _codes[path] = (stat.st_mtime, stat.st_size, code)
+    return entry
+
+def parts(result):
+    """Returns the pieces of output of a rendered template, without
+    joining them into one string (as str(result) would)
+    """
+    pieces = result.__dict__.get('_parts') \
+        if isinstance(result, web.template.TemplateResult) else None
+    if pieces is None:
+        return [result]
+    body = result._d.get('__body__')
+    return [body] + pieces if body else pieces
+
+def chunks(pieces, size=CHUNK_SIZE):
+    """Yields the strings in pieces, utf-8 encoded and gathered into
+    chunks of at least size bytes (but for the last)
+    """
+    chunk, n = [], 0
+    for piece in pieces:
+        piece = web.safestr(piece)
+        chunk.append(piece)
+        n += len(piece)
+        if n >= size:
+            yield ''.join(chunk)
+            chunk, n = [], 0
+    if chunk:
+        yield ''.join(chunk)
+
+class OutputCache(object):
+    """An LRU cache of rendered templates which expire after their
+    ttl, holding at most maxsize bytes of output. Counts hits,
+    misses and evictions in stats (and waltz_render_cache_total).
+    """
+
+    def __init__(self, maxsize=32 * 1024 * 1024):
+        self.maxsize = maxsize
+        self.size = 0
+        self.entries = OrderedDict() # key -> (expires, size, output)
+        self.stats = Counter()
+        self._lock = threading.Lock()
+
+    def _count(self, result):
+        self.stats.add(result)
+        metrics.inc('waltz_render_cache_total', result=result)
+
+    def get(self, key):
+        with self._lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None and entry[0] is not None \
+                    and entry[0] < time.time():
+                self.size -= entry[1]
+                entry = None
+            if entry is not None:
+                self.entries[key] = entry
+        self._count('hit' if entry else 'miss')
+        return entry[2] if entry else None
+
+    def put(self, key, output, ttl=None):
+        size = len(web.safestr(output))
+        if size > self.maxsize:
+            return output
+        expires = time.time() + ttl if ttl is not None else None
+        with self._lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+            self.entries[key] = (expires, size, output)
+            self.size += size
+            while self.size > self.maxsize:
+                _, (_, evicted, _) = self.entries.popitem(last=False)
+                self.size -= evicted
+                self._count('eviction')
+        return output
+
+    def clear(self):
+        with self._lock:
+            self.entries.clear()
+            self.size = 0
+
+cache = OutputCache()
+
+class Cached(object):
+    """Returned by Render.cached(); renders templates like the
+    Render it came from, but through the output cache
+    """
+
+    def __init__(self, owner, ttl, key=None, session=(), render=None,
+                 cache=cache):
+        self._owner = owner
+        self._render = render or owner
+        self._ttl = ttl
+        self._key = key
+        self._session = session
+        self._cache = cache
+        self._prefix = (os.path.abspath(owner._loc), owner._base is not None)
+
+    def _keyof(self, name, args, kwargs):
+        key = self._key
+        if key is None:
+            key = args, tuple(sorted(kwargs.items()))
+        elif hasattr(key, '__call__'):
+            key = key(*args, **kwargs)
+        if self._session:
+            session = web.ctx.session
+            key = key, tuple(session.get(f) for f in self._session)
+        return self._prefix + (name, key)
+
+    def __getattr__(self, name):
+        fn = getattr(self._render, name)
+        def cached_template(*args, **kwargs):
+            if self._owner._check:
+                return fn(*args, **kwargs)
+            key = self._keyof(name, args, kwargs)
+            try:
+                output = self._cache.get(key)
+            except TypeError: # unhashable arguments; don't cache
+                return fn(*args, **kwargs)
+            if output is None:
+                return self._cache.put(key, fn(*args, **kwargs), self._ttl)
+            content_type = getattr(self._owner._template(name),
+                                   'content_type', None)
+            if content_type and 'headers' in web.ctx:
+                web.header('Content-Type', content_type, unique=True)
+            return output
+        return cached_template
+
+class Streamed(object):
+    """Returned by Render.stream(); renders templates like the Render
+    it came from, but as generators of utf-8 chunks
+    """
+
+    # stands in for the page's content while rendering the base
+    MARKER = u'\x00waltz:content\x00'
+
+    def __init__(self, owner, size=CHUNK_SIZE, **head):
+        self._owner = owner
+        self._size = size
+        self._head = head
+
+    def _frame(self):
+        """Returns the base template's output before and after the
+        page's content
+        """
+        page = web.template.TemplateResult(self._head, __body__=self.MARKER)
+        head, _, tail = unicode(self._owner._base(page)).partition(
+            self.MARKER)
+        return head, tail
+
+    def __getattr__(self, name):
+        template = self._owner._template(name)
+        def streamed_template(*args, **kwargs):
+            head, tail = self._frame() if self._owner._base else ('', '')
+            def stream():
+                if head:
+                    yield web.safestr(head)
+                page = template(*args, **kwargs)
+                for chunk in chunks(parts(page), self._size):
+                    yield chunk
+                if tail:
+                    yield web.safestr(tail)
+            return stream()
+        return streamed_template
+
+class Template(web.template.Template):
+    """A Templetor template of the file filename, whose code comes
+    from (and is cached by) compiled()
+    """
+
+    def __init__(self, filename, cachedir=None, **keywords):
+        self._cachedir = cachedir
+        self.stat = None
+        web.template.Template.__init__(self, '', filename=filename,
+                                       **keywords)
+
+    def compile_template(self, text, filename):
+        compile = lambda text, path: web.template.Template.compile_template(
+            self, text, path)
+        mtime, size, code = compiled(filename, compile, self._cachedir)
+        self.stat = mtime, size
+        return code
+
+    def stale(self):
+        """True if the template's file changed since it was compiled"""
+        try:
+            stat = os.stat(self.filename)
+        except OSError:
+            return True
+        return (stat.st_mtime, stat.st_size) != self.stat
+
+class Render(web.template.Render):
+    """web.template.render, backed by the process-wide cache of
+    compiled templates. Templates are only checked for changes on
+    lookup if check is True (by default, if web.config.debug is set).
+    cachedir, if given, is where compiled templates are persisted.
+    """
+
+    def __init__(self, loc='templates', base=None, check=None,
+                 cachedir=None, **keywords):
+        if check is None:
+            check = web.config.get('debug', False)
+        self._check = check
+        self._cachedir = cachedir
+        web.template.Render.__init__(self, loc, cache=True, base=base,
+                                     **keywords)
+
+    def _load_template(self, name):
+        kind, path = self._lookup(name)
+        if kind == 'dir':
+            return Render(path, base=self._base, check=self._check,
+                          cachedir=self._cachedir, **self._keywords)
+        elif kind == 'file':
+            return Template(path, cachedir=self._cachedir, **self._keywords)
+        raise AttributeError, "No template named " + name
+
+    def _template(self, name):
+        t = self._cache.get(name)
+        if t is None or self._check and isinstance(t, Template) \
+                and t.stale():
+            t = self._cache[name] = self._load_template(name)
+        return t
+
+    def cached(self, ttl=None, key=None, session=(), render=None):
+        """Returns an object which renders templates like this Render,
+        but caches their output for ttl seconds (or until evicted),
+        keyed on the template, its arguments and the values of the
+        given session fields:
+
+        >>> render.cached(300, session=('email',)).index()
+
+        params:
+            key - a hashable value identifying the output, or a
+                  function of the template's arguments returning one,
+                  to use instead of the arguments themselves (output
+                  of templates called with unhashable arguments isn't
+                  cached)
+            render - the object which renders cache misses (by
+                     default, this Render)
+
+        Output isn't cached while templates are being checked for
+        changes (i.e. in debug mode).
+        """
+        return Cached(self, ttl, key=key, session=session, render=render)
+
+    def stream(self, size=CHUNK_SIZE, **head):
+        """Returns an object which renders templates like this Render,
+        but returns a generator of utf-8 chunks (which web.py sends as
+        they're produced) rather than one string: the base template's
+        output up to the page's content is yielded before the page is
+        rendered, then the page, size bytes at a time, then the rest.
+        The page's output is never joined into one string.
+
+        As the base is rendered before the page, it can't see the
+        page's $vars; pass any it needs as head:
+
+        >>> return render.stream(css='/static/css/list.css').listing(rows)
+
+        Handlers' processors (e.g. sessions) will have finished before
+        the page is rendered, so a streamed page may read, but not
+        modify, the session.
+        """
+        return Streamed(self, size=size, **head)
+
+    def precompile(self):
+        """Compiles every template under this Render's directory now
+        (e.g. at startup) rather than on first use. Returns the
+        number of templates compiled.
+        """
+        names = set(os.path.splitext(f)[0] for f in os.listdir(self._loc)
+                    if not f.startswith('.') and not f.endswith('~'))
+        n = 0
+        for name in sorted(names):
+            t = self._template(name)
+            n += t.precompile() if isinstance(t, Render) else 1
+        return n
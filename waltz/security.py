@@ -7,27 +7,254 @@
     authentication.
 """
 
+import os
+import time
+import hmac
+import atexit
+import threading
+import multiprocessing
+import base64
 import hashlib
-import random
-from utils import Storage, to36, valid_email, \
+import binascii
+from utils import Storage, to36, valid_email, safestr, \
     ALPHANUMERICS as ALPHAS
+import metrics
 
 username_regex = r'([A-Za-z0-9_%s]){%s,%s}$'
 passwd_regex = r'([A-Za-z0-9%s]){%s,%s}$'
 
+def _mac(secret, purpose, value, stamp):
+    mac = hmac.new(safestr(secret), '%s|%s|%s' % (purpose, value, stamp),
+                   hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(mac).rstrip('=')
+
+def sign(value, secret, purpose=''):
+    """Appends the time and an HMAC-SHA256 signature to the string
+    value, as value.time.signature. The signature covers purpose,
+    so a value signed for one purpose won't verify for another.
+
+    usage:
+    >>> signed = sign('username', 'secret', purpose='activate')
+    >>> unsign(signed, 'secret', purpose='activate')
+    'username'
+    """
+    stamp = to36(int(time.time()))
+    return '%s.%s.%s' % (value, stamp, _mac(secret, purpose, value, stamp))
+
+def unsign(signed, secret, purpose='', max_age=None):
+    """Returns the value signed by sign(), or None if signed is
+    malformed, its signature is invalid or (given max_age) it was
+    signed more than max_age seconds ago
+    """
+    try:
+        value, stamp, mac = safestr(signed).rsplit('.', 2)
+        age = time.time() - int(stamp, 36)
+    except ValueError:
+        return None
+    if not hmac.compare_digest(mac, _mac(secret, purpose, value, stamp)):
+        return None
+    if max_age is not None and age > max_age:
+        return None
+    return value
+
+def _sha256(passwd, salt, rounds):
+    return hashlib.sha256(salt + passwd).hexdigest()
+
+def _pbkdf2_sha256(passwd, salt, rounds):
+    return binascii.hexlify(hashlib.pbkdf2_hmac('sha256', passwd, salt,
+                                                rounds))
+
+class Entropy(object):
+    """Random bytes from os.urandom, read size bytes at a time rather
+    than with a system call per salt or token. The buffer is dropped
+    in forked children, which would otherwise repeat their parent's
+    bytes.
+    """
+
+    def __init__(self, size=4096):
+        self.size = size
+        self._buffer, self._pos = '', 0
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+
+    def read(self, n):
+        """Returns n random bytes"""
+        if self._pid != os.getpid():
+            self._lock = threading.Lock()
+            self._buffer, self._pos = '', 0
+            self._pid = os.getpid()
+        with self._lock:
+            if len(self._buffer) - self._pos < n:
+                self._buffer = self._buffer[self._pos:] + \
+                    os.urandom(max(self.size, n))
+                self._pos = 0
+            data = self._buffer[self._pos:self._pos + n]
+            self._pos += n
+        return data
+
+entropy = Entropy()
+
+def token(nbytes=16):
+    """Returns a random url-safe string holding nbytes of entropy"""
+    return base64.urlsafe_b64encode(entropy.read(nbytes)).rstrip('=')
+
+def randchars(length, alphabet=ALPHAS):
+    """Returns a random string of length characters from alphabet
+    (of at most 256), each equally likely: random bytes are mapped
+    onto alphabet modulo its length, discarding those above the
+    largest multiple of it which would favour its first characters.
+    """
+    limit = 256 - 256 % len(alphabet)
+    chars = []
+    while len(chars) < length:
+        chars.extend(alphabet[ord(b) % len(alphabet)]
+                     for b in entropy.read(length - len(chars))
+                     if ord(b) < limit)
+    return ''.join(chars)
+
+class Saturated(Exception):
+    """Raised when a Verifier already has as many hashes queued or in
+    progress as it allows; callers should shed the request (e.g. with
+    503 Service Unavailable) rather than wait
+    """
+
+class Verifier(object):
+    """Computes password hashes in a pool of worker processes, so
+    that a burst of logins or registrations, each costing tens of
+    milliseconds of CPU, can't starve the WSGI threads serving other
+    routes. At most maxsize hashes may be queued or in progress at
+    once; further requests raise Saturated immediately. Reports
+    waltz_verifier_queue (hashes queued or in progress),
+    waltz_verify_seconds and waltz_verifier_rejected_total to
+    waltz.metrics.
+
+    usage:
+    >>> Account.verifier = Verifier(processes=2, maxsize=32)
+
+    Hashers (see Account.hashers) must be module level functions, so
+    they can be sent to the worker processes.
+    """
+
+    def __init__(self, processes=None, maxsize=64, timeout=30):
+        self.processes = processes
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(maxsize)
+        self._lock = threading.Lock()
+        self._pool = None
+        self._pid = None
+
+    def pool(self):
+        """Returns this process's worker pool, started on first use
+        (and again in forked children, which can't use the parent's)
+        """
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._pool = multiprocessing.Pool(self.processes)
+                    self._pid = os.getpid()
+                    atexit.register(self.close)
+        return self._pool
+
+    def run(self, hasher, *args):
+        """Returns hasher(*args), computed by a worker process. Raises
+        Saturated if maxsize hashes are already queued or in progress.
+        """
+        if not self._slots.acquire(False):
+            metrics.inc('waltz_verifier_rejected_total')
+            raise Saturated("%s password hashes are already in progress"
+                            % self.maxsize)
+        metrics.gauge('waltz_verifier_queue', 1)
+        try:
+            with metrics.timed('waltz_verify_seconds'):
+                return self.pool().apply_async(hasher, args).get(
+                    self.timeout)
+        finally:
+            metrics.gauge('waltz_verifier_queue', -1)
+            self._slots.release()
+
+    def close(self):
+        """Stops this process's worker pool"""
+        if self._pid == os.getpid():
+            self._pool.terminate()
+            self._pool.join()
+            self._pid = None
+
 class Account(object):
     """The base Account class provides the basic functions for allowing
     user account creation and authentication, however it should be
     extended to allow user retrieval.
+
+    Password hashes are versioned: scheme$rounds$hexdigest, where
+    scheme names one of Account.hashers. Unversioned hashes (a bare
+    hexdigest) are those of the original single pass of sha256.
     """
 
+    # password hashing functions by scheme name, each called as
+    # hasher(passwd, username + salt, rounds) -> hexdigest
+    hashers = {'sha256': _sha256,
+               'pbkdf2_sha256': _pbkdf2_sha256}
+    # scheme and work factor (iterations) of newly hashed passwords.
+    # Each login costs about rounds iterations of hashing, so size it
+    # to the latency budget; users whose hashes were made with an older
+    # scheme or rounds are rehashed by User.authenticate
+    scheme = 'pbkdf2_sha256'
+    rounds = 100000
+    # if set, a Verifier which computes hashes out of process
+    verifier = None
+    # key which signs tokens (see Account.token)
+    secret = None
+
     @classmethod
     def authenticate(cls, username, passwd, salt, uhash):
         """Authenticates/validates a user's credentials by comparing
         their username and password versus their computed salted hash.
         A successful authentication results in True, False otherwise.
         """
-        return cls._roast(username + salt + passwd) == uhash
+        return cls._verify(username, passwd, salt, uhash)
+
+    @classmethod
+    def _verify(cls, username, passwd, salt, uhash):
+        """Hashes passwd as uhash was hashed (whatever its scheme and
+        rounds) and compares them in constant time
+        """
+        scheme, rounds = cls._scheme(uhash)
+        return hmac.compare_digest(
+            safestr(cls._hash(username, salt, passwd, scheme, rounds)),
+            safestr(uhash))
+
+    @classmethod
+    def needs_rehash(cls, uhash):
+        """True if uhash wasn't made with the current scheme and rounds"""
+        scheme, rounds = cls._scheme(uhash)
+        return scheme != cls.scheme or \
+            (scheme != 'sha256' and rounds != cls.rounds)
+
+    @staticmethod
+    def _scheme(uhash):
+        """Returns the (scheme, rounds) a password hash was made with"""
+        if '$' not in uhash:
+            return 'sha256', None
+        scheme, rounds, _ = uhash.split('$', 2)
+        return scheme, int(rounds)
+
+    @classmethod
+    def _hash(cls, username, salt, passwd, scheme=None, rounds=None):
+        """Returns the versioned hash of passwd, by scheme and rounds
+        (by default, Account.scheme and Account.rounds)
+        """
+        scheme = scheme or cls.scheme
+        rounds = rounds or cls.rounds
+        if scheme not in cls.hashers:
+            raise ValueError("Unknown password hash scheme '%s'" % scheme)
+        args = safestr(passwd), safestr(username + salt), rounds
+        if cls.verifier is not None:
+            digest = cls.verifier.run(cls.hashers[scheme], *args)
+        else:
+            digest = cls.hashers[scheme](*args)
+        if scheme == 'sha256':
+            return digest
+        return '%s$%s$%s' % (scheme, rounds, digest)
 
     @classmethod
     def register(cls, username, passwd, passwd2=None, salt='', email='', **kwargs):
@@ -52,10 +279,12 @@ class Account(object):
         # A salt has been included along with the following function call to
         # guarantee idempotence (i.e. a consistent/same uhash with each call)
         >>> Account.register("username", "password", salt="123456789")
-        <Storage {'username': 'username', 'uhash': '021d98a32375ed850f459fe484c3ab2e352fc2801ef13eae274103befc9d0274', 'salt': '123456789', 'email': ''}>
+        <Storage {'username': 'username', 'uhash': 'pbkdf2_sha256$100000$6c046a79fb276f1857bbad4772bf8c09cf20086656e640d17642cfe595fbd633',
+        'salt': '123456789', 'email': ''}>
         # using additional kwargs, such as age (i.e. age=24) to add user attributes
         >>> Account.register("username", "password", salt="123456789", age=24)
-        <Storage {'username': 'username', 'uhash': '021d98a32375ed850f459fe484c3ab2e352fc2801ef13eae274103befc9d0274', 'salt': '123456789', 'email': '', 'age': 24}>
+        <Storage {'username': 'username', 'uhash': 'pbkdf2_sha256$100000$6c046a79fb276f1857bbad4772bf8c09cf20086656e640d17642cfe595fbd633',
+        'salt': '123456789', 'email': '', 'age': 24}>
         """        
         if not passwd: raise ValueError('Password Required')
 
@@ -65,7 +294,7 @@ class Account(object):
         if passwd2 and not passwd == passwd2:
             raise ValueError('Passwords do not match')
         salt = salt or cls._salt()
-        uhash = cls._roast(username + salt + passwd)        
+        uhash = cls._hash(username, salt, passwd)
         return Storage(zip(('username', 'salt', 'uhash', 'email'), 
                         (username, salt, uhash, email)) + kwargs.items())
 
@@ -74,10 +303,54 @@ class Account(object):
         """Generates a public key which can be used as a public unique
         identifier token in account activation emails and other
         account specific situations where you wish to create a url
-        intended to only work for a specific user.
+        intended to only work for a specific user. (Account.token
+        makes tokens which expire, and which can be checked without
+        looking the user up.)
         """
         return cls._roast(uid + username + salt)
 
+    @classmethod
+    def token(cls, username, purpose, bind=''):
+        """Returns a url-safe token for username, e.g. for a link in
+        an account activation or password reset email, signed with
+        Account.secret for purpose and stamped with the time it was
+        made. check_token() verifies it without looking up the user.
+
+        params:
+            purpose - what the token is for (e.g. 'activate'); a token
+                      made for one purpose isn't valid for another
+            bind - a value which check_token must be given too, e.g.
+                   the user's current uhash, so that a password reset
+                   token stops working once the password is reset
+
+        usage:
+        >>> token = Account.token('username', 'reset', bind=user.uhash)
+        >>> Account.check_token(token, 'reset', max_age=3600,
+        ...                     bind=user.uhash)
+        'username'
+        """
+        if not cls.secret:
+            raise ValueError("Account.secret is required to sign tokens")
+        value = base64.urlsafe_b64encode(safestr(username)).rstrip('=')
+        return sign(value, cls.secret, '%s|%s' % (purpose, bind))
+
+    @classmethod
+    def check_token(cls, token, purpose, max_age=None, bind=''):
+        """Returns the username which token was made for (by
+        Account.token, for purpose and bind), or None if it's invalid
+        or older than max_age seconds
+        """
+        if not cls.secret:
+            raise ValueError("Account.secret is required to sign tokens")
+        value = unsign(token, cls.secret, '%s|%s' % (purpose, bind),
+                       max_age=max_age)
+        if value is None:
+            return None
+        try:
+            return base64.urlsafe_b64decode(value + '=' * (-len(value) % 4))
+        except TypeError:
+            return None
+
     @classmethod
     def _salt(cls, length=12):
         """http://en.wikipedia.org/wiki/Salt_(cryptography)
@@ -86,7 +359,7 @@ class Account(object):
         appended to a password prior to hashing to increase security
         and prevent against various brute force attacks, such as
         rainbow-table lookups."""
-        return ''.join([random.choice(ALPHAS) for i in range(length)])
+        return randchars(length)
 
     @classmethod
     def _roast(cls, beans, chash=hashlib.sha256):
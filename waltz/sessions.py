@@ -0,0 +1,560 @@
+#-*- coding: utf-8 -*-
+
+"""
+    sessions
+    ~~~~~~~~
+    Session handling for waltz, built on web.py's web.session: a lazy
+    Session which reports timings to waltz.metrics, and session
+    stores for dancefloor(..., session_store=...).
+
+    usage:
+    >>> from waltz.sessions import CachedStore, DiskStore
+    >>> store = CachedStore(DiskStore('sessions'), capacity=10000)
+    >>> app = waltz.setup.dancefloor(urls, globals(), sessions={},
+    ...                              session_store=store)
+
+    or, to keep (small) sessions in signed cookies, with no server
+    side session state at all:
+
+    >>> from waltz.sessions import CookieStore
+    >>> app = waltz.setup.dancefloor(urls, globals(), sessions={},
+    ...                              session_store=CookieStore(secret))
+"""
+
+import os
+import time
+import json
+import zlib
+import errno
+import atexit
+import base64
+import hashlib
+import tempfile
+import threading
+import cPickle as pickle
+from collections import OrderedDict
+import web
+import metrics
+from waltz import logger
+from security import sign, unsign
+
+class Session(web.session.Session):
+    """A web.py Session which is only loaded from its store when a
+    request first accesses it, and only saved if the request changed
+    it. Requests which never touch the session (static files,
+    anonymous API calls) do no session I/O at all; an unchanged
+    session is merely touch()ed in stores which support it, to
+    postpone its expiry.
+
+    Reports the time spent loading and saving sessions to
+    waltz.metrics (waltz_session_seconds).
+    """
+
+    def _processor(self, handler):
+        self._cleanup()
+        web.ctx.waltz_session = state = web.storage(loaded=False,
+                                                    digest=None)
+        try:
+            return handler()
+        finally:
+            if state.loaded:
+                self._save()
+
+    def _ensure(self):
+        """Loads the session, once per request, when first accessed"""
+        state = web.ctx.get('waltz_session')
+        if state is not None and not state.loaded:
+            state.loaded = True
+            self._load()
+            state.digest = self._digest()
+
+    def _digest(self):
+        return hashlib.sha1(pickle.dumps(dict(self._data),
+                                         pickle.HIGHEST_PROTOCOL)).digest()
+
+    def __getitem__(self, key):
+        self._ensure()
+        return self._data[key]
+
+    def __setitem__(self, key, value):
+        self._ensure()
+        self._data[key] = value
+
+    def __delitem__(self, key):
+        self._ensure()
+        del self._data[key]
+
+    def __contains__(self, key):
+        self._ensure()
+        return key in self._data
+
+    def __getattr__(self, name):
+        self._ensure()
+        return getattr(self._data, name)
+
+    def __setattr__(self, name, value):
+        if name in self.__slots__:
+            object.__setattr__(self, name, value)
+        else:
+            self._ensure()
+            setattr(self._data, name, value)
+
+    def __delattr__(self, name):
+        self._ensure()
+        delattr(self._data, name)
+
+    def _load(self):
+        with metrics.timed('waltz_session_seconds', op='load'):
+            web.session.Session._load(self)
+
+    def _save(self):
+        state = web.ctx.get('waltz_session')
+        if state is not None and state.digest == self._digest():
+            touch = getattr(self.store, 'touch', None)
+            if touch:
+                touch(self.session_id)
+            return
+        with metrics.timed('waltz_session_seconds', op='save'):
+            web.session.Session._save(self)
+
+class DiskStore(web.session.DiskStore):
+    """web.py's DiskStore (and file format), but sessions are written
+    atomically and expire by the time they were last written (mtime)
+    rather than read (atime, which is often not kept), which touch()
+    can refresh without rewriting the session.
+    """
+
+    def __setitem__(self, key, value):
+        self.write(key, value)
+
+    def write(self, key, value):
+        """Writes the session and returns the stat() of the file
+        written, as of when it was renamed into place
+        """
+        path = self._get_path(key)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path),
+                                   prefix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(self.encode(value))
+                f.flush()
+                st = os.fstat(f.fileno())
+            os.rename(tmp, path)
+        except:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        return st.st_mtime, st.st_size
+
+    def stat(self, key):
+        """Returns the (mtime, size) of the session's file, which
+        change whenever it's written, or None if there is no such
+        session
+        """
+        try:
+            st = os.stat(self._get_path(key))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+        return st.st_mtime, st.st_size
+
+    def mtime(self, key):
+        """Returns when the session was last written or touched, or
+        None if there is no such session
+        """
+        try:
+            return os.stat(self._get_path(key)).st_mtime
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def touch(self, key):
+        """Marks the session as current, postponing its expiry"""
+        try:
+            os.utime(self._get_path(key), None)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def cleanup(self, timeout):
+        expired = time.time() - timeout
+        for f in os.listdir(self.root):
+            path = self._get_path(f)
+            if f.startswith('.') or not os.path.isfile(path):
+                continue
+            if (self.mtime(f) or expired) < expired:
+                try:
+                    os.remove(path)
+                except OSError as e:
+                    if e.errno != errno.ENOENT:
+                        raise
+
+class ShardedStore(DiskStore):
+    """A DiskStore which spreads session files over hashed shard
+    directories, depth levels deep (256 directories per level), so no
+    directory holds more than a small fraction of the sessions:
+
+        <root>/<2 hex chars>/<2 hex chars>/<session id>
+
+    cleanup() is incremental: each call examines at most batch
+    sessions, one shard directory at a time, resuming where the last
+    call stopped. It returns True once a full pass is complete. As
+    web.py only calls cleanup() once per session timeout (a day, by
+    default), a ShardedStore must sit behind a CachedStore, whose
+    sweeper keeps calling it until each pass completes; dancefloor
+    wraps it in one if given it as its session_store.
+    """
+
+    # cleanup() only sweeps part of the store per call
+    incremental = True
+
+    def __init__(self, root, depth=2, batch=1000):
+        DiskStore.__init__(self, root)
+        self.depth = depth
+        self.batch = batch
+        self._cursor = None
+
+    def _get_path(self, key):
+        if os.path.sep in key:
+            raise ValueError, "Bad key: %s" % repr(key)
+        digest = hashlib.sha1(key).hexdigest()
+        shards = [digest[2 * n:2 * n + 2] for n in range(self.depth)]
+        return os.path.join(self.root, *(shards + [key]))
+
+    def write(self, key, value):
+        shard = os.path.dirname(self._get_path(key))
+        if not os.path.isdir(shard):
+            try:
+                os.makedirs(shard)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        return DiskStore.write(self, key, value)
+
+    def _shards(self, path=None, depth=None):
+        """Yields the leaf shard directories, in order"""
+        path = path or self.root
+        depth = self.depth if depth is None else depth
+        if not depth:
+            yield path
+            return
+        try:
+            names = sorted(os.listdir(path))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return
+        for name in names:
+            if len(name) == 2 and os.path.isdir(os.path.join(path, name)):
+                for shard in self._shards(os.path.join(path, name),
+                                          depth - 1):
+                    yield shard
+
+    def _sessions(self):
+        for shard in self._shards():
+            for f in os.listdir(shard):
+                if not f.startswith('.'):
+                    yield f
+
+    def cleanup(self, timeout):
+        if self._cursor is None:
+            self._cursor = self._sessions()
+        expired = time.time() - timeout
+        for n in xrange(self.batch):
+            try:
+                f = self._cursor.next()
+            except (StopIteration, OSError):
+                self._cursor = None
+                return True
+            if (self.mtime(f) or expired) < expired:
+                try:
+                    os.remove(self._get_path(f))
+                except OSError as e:
+                    if e.errno != errno.ENOENT:
+                        raise
+        return False
+
+def shard(flat, store):
+    """Moves the session files of a flat DiskStore directory, flat,
+    into the ShardedStore store (which may share its root) and
+    returns how many were moved
+    """
+    moved = 0
+    for f in os.listdir(flat):
+        path = os.path.join(flat, f)
+        if f.startswith('.') or not os.path.isfile(path):
+            continue
+        target = store._get_path(f)
+        if not os.path.isdir(os.path.dirname(target)):
+            os.makedirs(os.path.dirname(target))
+        os.rename(path, target)
+        moved += 1
+    return moved
+
+class CachedStore(web.session.Store):
+    """A bounded, in-process LRU cache of sessions in front of a
+    session store (e.g. DiskStore):
+
+    * reads are served from the cache. If the store can report
+      stat(key), the (mtime, size) of the session, one stat checks
+      that no other worker has since written the session; otherwise
+      the cache is trusted. Sessions are stat()ed before they're
+      read, and stores which can write(key, value) report the stat
+      of the file they wrote, so a session is never cached under a
+      newer write's stat.
+    * writes of a session identical to the one cached are skipped;
+      the store's copy is merely touch()ed (if supported) once it is
+      older than refresh seconds, to postpone its expiry.
+    * expired sessions are cleaned up by a background thread every
+      interval seconds, instead of web.py's sweep of the whole store
+      from within a request. Stores with incremental cleanups (e.g.
+      ShardedStore) are swept one step every pause seconds until
+      their pass completes. Sweeps which fail are logged to logpath
+      (if given) and retried after interval seconds.
+    """
+
+    def __init__(self, store, capacity=1024, interval=600, refresh=60,
+                 pause=1, logpath=None):
+        self.store = store
+        self.capacity = capacity
+        self.interval = interval
+        self.refresh = refresh
+        self.pause = pause
+        self.logpath = logpath
+        self.cache = OrderedDict() # key -> ((mtime, size), pickled)
+        self._lock = threading.Lock()
+        self._timeout = None
+        self._pid = None
+        self._stop = threading.Event()
+        self._sweeper = None
+
+    def _mtime(self, key):
+        mtime = getattr(self.store, 'mtime', None)
+        return mtime(key) if mtime else None
+
+    def _stat(self, key):
+        stat = getattr(self.store, 'stat', None)
+        return stat(key) if stat else None
+
+    def _cached(self, key):
+        """Returns the pickled session cached under key if it is
+        current with the store, else None
+        """
+        with self._lock:
+            entry = self.cache.get(key)
+        if entry is None:
+            return None
+        if self._stat(key) != entry[0]:
+            with self._lock:
+                self.cache.pop(key, None)
+            return None
+        with self._lock:
+            if key in self.cache:
+                self.cache[key] = self.cache.pop(key)
+        return entry[1]
+
+    def _cache(self, key, stat, pickled):
+        with self._lock:
+            self.cache.pop(key, None)
+            self.cache[key] = (stat, pickled)
+            while len(self.cache) > self.capacity:
+                self.cache.popitem(last=False)
+
+    def __contains__(self, key):
+        return self._cached(key) is not None or key in self.store
+
+    def __getitem__(self, key):
+        pickled = self._cached(key)
+        if pickled is not None:
+            metrics.inc('waltz_session_cache_total', result='hit')
+            return pickle.loads(pickled)
+        metrics.inc('waltz_session_cache_total', result='miss')
+        stat = self._stat(key)
+        value = self.store[key]
+        self._cache(key, stat, pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+        return value
+
+    def __setitem__(self, key, value):
+        pickled = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        if self._cached(key) == pickled:
+            self.touch(key)
+            return
+        write = getattr(self.store, 'write', None)
+        if write:
+            stat = write(key, value)
+        else:
+            self.store[key] = value
+            stat = None
+        if stat is not None or not hasattr(self.store, 'stat'):
+            self._cache(key, stat, pickled)
+        else:
+            with self._lock:
+                self.cache.pop(key, None)
+
+    def touch(self, key):
+        """touch()es the store's copy of the session (if supported)
+        once it is older than refresh seconds
+        """
+        touch = getattr(self.store, 'touch', None)
+        mtime = self._mtime(key)
+        if touch and mtime and time.time() - mtime > self.refresh:
+            touch(key)
+            # its stat changed; re-read the session when next asked
+            with self._lock:
+                self.cache.pop(key, None)
+
+    def __delitem__(self, key):
+        with self._lock:
+            self.cache.pop(key, None)
+        del self.store[key]
+
+    def cleanup(self, timeout):
+        """Called by web.py from within requests; (re)starts the
+        background sweeper rather than sweeping the store here
+        """
+        self._timeout = timeout
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._sweeper = threading.Thread(target=self._sweep,
+                                             name='waltz-sessions')
+            self._sweeper.daemon = True
+            self._sweeper.start()
+            self._pid = os.getpid()
+        atexit.register(self.close)
+
+    def _sweep(self):
+        while not self._stop.is_set():
+            try:
+                done = self.sweep(self._timeout)
+            except Exception as e:
+                done = True
+                if self.logpath:
+                    logger(self.logpath, "Session sweep failed: %s" % e,
+                           method='error')
+            self._stop.wait(self.interval if done else self.pause)
+
+    def sweep(self, timeout):
+        """Removes sessions idle for more than timeout seconds from
+        the store and the cache. Returns False if the store's cleanup
+        is incremental and its pass isn't complete.
+        """
+        done = self.store.cleanup(timeout) is not False
+        expired = time.time() - timeout
+        with self._lock:
+            for key, (stat, _) in self.cache.items():
+                if stat is not None and stat[0] < expired:
+                    del self.cache[key]
+        return done
+
+    def close(self):
+        """Stops the background sweeper"""
+        if self._pid == os.getpid():
+            self._stop.set()
+            self._sweeper.join()
+
+class CookieStore(web.session.Store):
+    """Keeps each session in a cookie on the client (alongside
+    web.py's session id cookie), so serving a session requires no
+    server side I/O and any worker on any host can answer any
+    request. The cookie holds the session as JSON, zlib compressed
+    when that makes it smaller, and signed with secret (see
+    waltz.security.sign) so clients can't tamper with it. Sessions
+    expire after web.config.session_parameters.timeout seconds.
+
+    Only suitable for small sessions of JSON serializable values:
+    strings come back as unicode and tuples as lists. Writing a
+    session larger than max_size bytes raises ValueError. An
+    unchanged session's cookie is only re-sent once it is more than
+    refresh seconds old.
+    """
+
+    def __init__(self, secret, cookie_name=None, compress=True,
+                 max_size=4000, refresh=60):
+        if not secret:
+            raise ValueError("CookieStore requires a secret")
+        self.secret = secret
+        self.cookie_name = cookie_name
+        self.compress = compress
+        self.max_size = max_size
+        self.refresh = refresh
+
+    @property
+    def _config(self):
+        return web.config.session_parameters
+
+    @property
+    def _name(self):
+        return self.cookie_name or self._config.cookie_name + '_data'
+
+    def encode(self, session_dict):
+        data = json.dumps(session_dict, separators=(',', ':'))
+        if self.compress:
+            packed = zlib.compress(data)
+            if len(packed) < len(data):
+                return 'z' + base64.urlsafe_b64encode(packed)
+        return 'j' + base64.urlsafe_b64encode(data)
+
+    def decode(self, session_data):
+        data = base64.urlsafe_b64decode(session_data[1:])
+        if session_data[0] == 'z':
+            data = zlib.decompress(data)
+        return json.loads(data)
+
+    def _payload(self, key, max_age=None):
+        """Returns the verified, encoded session in the request's
+        cookie for session id key, or None
+        """
+        signed = web.cookies().get(self._name)
+        if not signed:
+            return None
+        if max_age is None:
+            max_age = self._config.timeout
+        return unsign(signed, self.secret, purpose=key, max_age=max_age)
+
+    def __contains__(self, key):
+        return self._payload(key) is not None
+
+    def __getitem__(self, key):
+        payload = self._payload(key)
+        if payload is None:
+            raise KeyError(key)
+        try:
+            return self.decode(payload)
+        except (TypeError, ValueError, zlib.error):
+            raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        payload = self.encode(value)
+        if self._payload(key, max_age=self.refresh) == payload:
+            return
+        signed = sign(payload, self.secret, purpose=key)
+        if len(signed) > self.max_size:
+            raise ValueError("Session of %s bytes is too large for a "
+                             "cookie" % len(signed))
+        self._setcookie(signed)
+
+    def __delitem__(self, key):
+        self._setcookie('', expires=-1)
+
+    def touch(self, key):
+        """Re-signs the request's session cookie once it is older than
+        refresh seconds, postponing its expiry
+        """
+        payload = self._payload(key)
+        if payload is not None and \
+                self._payload(key, max_age=self.refresh) is None:
+            self._setcookie(sign(payload, self.secret, purpose=key))
+
+    def _setcookie(self, value, expires=''):
+        config = self._config
+        web.setcookie(self._name, value, expires=expires,
+                      domain=config.cookie_domain, path=config.cookie_path,
+                      httponly=config.httponly, secure=config.secure)
+
+    def cleanup(self, timeout):
+        """Expired cookies are rejected on read; nothing to clean"""
+        pass
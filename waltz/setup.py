@@ -11,10 +11,17 @@
 """
 
 import os
+import re
+import time
 from functools import partial
 import web
 from web import wsgiserver
 from reloader import PeriodicReloader
+import analytics
+import metrics
+from sessions import Session, CachedStore, DiskStore
+from rendering import Render
+from security import Account, Verifier
 _https = wsgiserver.CherryPyWSGIServer
 
 def dancefloor(urls, fvars, sessions=False, autoreload=False,
@@ -28,14 +35,40 @@ def dancefloor(urls, fvars, sessions=False, autoreload=False,
                 root main.py app
         sessions - a boolean False denotes sessions will not be used.
                    Otherwise, a dict is expected which is used as
-                   the default session data structure / values.
+                   the default session data structure / values. Sessions
+                   are only loaded from the store by requests which
+                   access them (see waltz.sessions.Session).
     **kwargs:
         env - a dict of environment ctx vars + funcs which will
               be made globally accesible from within html templates
         session_store - can be overridden with a web.session storage
                         method s.t. the user may use DBStore or specify
                         an alternate path besides the default, 'sessions/'
+                        (by default a waltz.sessions.CachedStore in
+                        front of a waltz.sessions.DiskStore). Stores
+                        which clean up incrementally (e.g. ShardedStore)
+                        are put behind a CachedStore.
         session - a dictionary representing a default init'd session
+        analytics - a dict of options for the write-behind sink
+                    used by @track (see waltz.analytics.Sink), e.g.
+                    {'batch': 500, 'interval': 2.0,
+                     'fields': ('time', 'path', 'status')}
+        instrument - if True, record per-route latency histograms,
+                     in-flight requests and time spent in sessions,
+                     rendering and @track to waltz.metrics (served by
+                     waltz.modules.Metrics)
+        profiler - if True, enables the sampling profiler served by
+                   waltz.modules.Profiler (off by default)
+        precompile - if True, compile every template in templates/
+                     at startup rather than on first use
+        template_cache - a directory in which to persist compiled
+                         templates, so new worker processes needn't
+                         compile them (see waltz.rendering)
+        verifier - a dict of options for a waltz.security.Verifier,
+                   e.g. {'processes': 2, 'maxsize': 32}, to hash
+                   passwords in a pool of worker processes
+        secret - the key with which Account.token signs activation
+                 and password reset tokens
     """
     _path = os.path.dirname(os.path.realpath(fvars['__file__']))
     app = web.application(_preprocess(urls), fvars, autoreload=autoreload)
@@ -45,10 +78,44 @@ def dancefloor(urls, fvars, sessions=False, autoreload=False,
     if isinstance((kwargs.get('ssl', None)), tuple):        
         _https.ssl_certificate, _https.ssl_private_key = kwargs.get('ssl')
 
+    def setup_instrumentation():
+        """Outermost processor: times each request, labelled by the
+        name of the class handling its route
+        """
+        if not kwargs.get('instrument'):
+            return
+        metrics.registry.enabled = True
+        routes = [(re.compile('^%s$' % pattern), name) for pattern, name
+                  in zip(urls[::2], urls[1::2])]
+        def route():
+            for pattern, name in routes:
+                if pattern.match(web.ctx.path):
+                    return name
+            return 'unmatched'
+        def instrument(handler):
+            labels = {'route': route()}
+            metrics.gauge('waltz_requests_in_flight', 1)
+            start = time.time()
+            try:
+                return handler()
+            finally:
+                metrics.gauge('waltz_requests_in_flight', -1)
+                metrics.observe('waltz_request_seconds',
+                                time.time() - start, **labels)
+                metrics.inc('waltz_requests_total',
+                            status=web.ctx.status[:3], **labels)
+        app.add_processor(instrument)
+
     def setup_rendering():
-        html = partial(web.template.render, '%s/templates/' % _path)
+        html = partial(Render, '%s/templates/' % _path, check=debug,
+                       cachedir=kwargs.get('template_cache'))
         slender = html(globals=env)
         render = html(base='base', globals=env)
+        if kwargs.get('precompile'):
+            render.precompile()
+        if kwargs.get('instrument'):
+            render = metrics.TimedRender(render)
+            slender = metrics.TimedRender(slender)
         def render_hook():
             web.ctx.render = render
             web.ctx.slender = slender
@@ -61,13 +128,19 @@ def dancefloor(urls, fvars, sessions=False, autoreload=False,
             return
         def default_store():
             """Default method of storing session: DiskStore
-            created directory sessions/ by default to store sessions"""
+            created directory sessions/ by default to store sessions,
+            behind an in-process LRU cache"""
             path = _path + '/sessions'
             if not os.path.exists(path):
                 os.makedirs(path)
-            return web.session.DiskStore(path)
-
-        store = kwargs.get('session_store', default_store())
+            return CachedStore(DiskStore(path))
+
+        store = kwargs.get('session_store') or default_store()
+        if getattr(store, 'incremental', False):
+            # only a CachedStore's sweeper completes its cleanups
+            store = CachedStore(store)
+        if isinstance(store, CachedStore) and store.logpath is None:
+            store.logpath = kwargs.get('logging', '%s/events.log' % _path)
         session = init_sessions(web, app, store, sessions)
         env['session'] = session
 
@@ -82,13 +155,21 @@ def dancefloor(urls, fvars, sessions=False, autoreload=False,
             web.wsgi.runwsgi = fcgi
         db = kwargs.get('db', "%s/db" % _path)
         lgr = kwargs.get('logging', '%s/events.log' % _path)
+        sink = analytics.sink(db, logpath=lgr, **kwargs.get('analytics', {}))
+        if kwargs.get('verifier') is not None:
+            Account.verifier = Verifier(**kwargs['verifier'])
+        if kwargs.get('secret'):
+            Account.secret = kwargs['secret']
         def waltz_hook():
             web.ctx.waltz = {"debug": debug,
                              "db": db,
-                             "logging": lgr
+                             "logging": lgr,
+                             "analytics": sink,
+                             "profiler": kwargs.get('profiler', False)
                              }
         app.add_processor(web.loadhook(waltz_hook))        
 
+    setup_instrumentation()
     setup_rendering()
     setup_sessions()
     setup_waltz()
@@ -97,7 +178,7 @@ def dancefloor(urls, fvars, sessions=False, autoreload=False,
 def init_sessions(web, app, store, session):
     """kwargs is used to inject options like 'cart' into session."""
     web.config.session_parameters['ignore_expiry'] = True
-    session = web.session.Session(app, store, initializer=session)
+    session = Session(app, store, initializer=session)
     def inject_session():
         """closure; uncalled function which wraps session is
         passed to the web loadhook and invoked elsewhere and at a
@@ -0,0 +1,205 @@
+#-*- coding: utf-8 -*-
+
+"""
+    store
+    ~~~~~
+    A flatfile record store which keeps every record in its own
+    pickled file, so reading or writing one record never requires
+    unpickling (or rewriting) any other record.
+
+    Records are addressed by a string key. Files are named after the
+    sha1 of their key and spread over 256 shard directories:
+
+        <path>/<2 hex chars>/<sha1 of key>
+
+    Each file holds two pickles, the key followed by the record, so
+    keys can be listed without unpickling the records themselves.
+    Writes go to a temporary file which is then renamed over the
+    record, so readers never observe a partially written record.
+    Read-modify-write cycles are serialized across threads and
+    processes by an flock on <path>/.lock (see RecordStore.lock).
+"""
+
+import os
+import errno
+import fcntl
+import hashlib
+import tempfile
+import threading
+import cPickle as pickle
+from contextlib import contextmanager
+from utils import safestr
+
+_held = threading.local()
+
+@contextmanager
+def filelock(path):
+    """Holds an exclusive flock on the file at path (created if need
+    be) for the duration of the with block. Reentrant within a
+    thread; blocks other threads and processes.
+    """
+    path = os.path.abspath(path)
+    held = _held.__dict__.setdefault('paths', {})
+    if path in held:
+        held[path] += 1
+        try:
+            yield
+        finally:
+            held[path] -= 1
+        return
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        held[path] = 1
+        try:
+            yield
+        finally:
+            del held[path]
+    finally:
+        os.close(fd)
+
+class RecordStore(object):
+    """A dict-like store of pickled records, one file per record.
+
+    usage:
+    >>> store = RecordStore('/tmp/db.users')
+    >>> store.put('username', {'username': 'username'})
+    {'username': 'username'}
+    >>> store.get('username')
+    {'username': 'username'}
+    >>> store.delete('username')
+    True
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def _file(self, key):
+        digest = hashlib.sha1(safestr(key)).hexdigest()
+        return os.path.join(self.path, digest[:2], digest)
+
+    def _shards(self):
+        """Yields the shard directories which currently exist"""
+        try:
+            names = os.listdir(self.path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return
+        for name in sorted(names):
+            shard = os.path.join(self.path, name)
+            if len(name) == 2 and os.path.isdir(shard):
+                yield shard
+
+    def _read(self, fname, record=True):
+        """Returns the (key, record) pair pickled at fname. If record
+        is False, only the key is unpickled (record is None).
+        """
+        with open(fname, 'rb') as f:
+            key = pickle.load(f)
+            return key, (pickle.load(f) if record else None)
+
+    def get(self, key, default=None):
+        try:
+            return self._read(self._file(key))[1]
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return default
+
+    def put(self, key, record):
+        """Atomically writes record under key, replacing any existing
+        record, and returns the record.
+        """
+        fname = self._file(key)
+        shard = os.path.dirname(fname)
+        if not os.path.isdir(shard):
+            try:
+                os.makedirs(shard)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        fd, tmp = tempfile.mkstemp(dir=shard, prefix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(safestr(key), f, pickle.HIGHEST_PROTOCOL)
+                pickle.dump(record, f, pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp, fname)
+        except:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        return record
+
+    def lock(self):
+        """Exclusive, process-safe lock over this store. Hold it
+        around any read-modify-write so concurrent writers (threads
+        or WSGI worker processes) can't lose each other's updates:
+
+        >>> with store.lock():
+        ...     store.put('hits', store.get('hits', 0) + 1)
+        """
+        if not os.path.isdir(self.path):
+            try:
+                os.makedirs(self.path)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        return filelock(os.path.join(self.path, '.lock'))
+
+    def update(self, key, func, default=None):
+        """Atomically replaces the record under key with
+        func(record), where record is default if key is absent, and
+        returns the new record.
+        """
+        with self.lock():
+            return self.put(key, func(self.get(key, default)))
+
+    def delete(self, key):
+        """Removes the record under key. Returns False if there was
+        no such record.
+        """
+        try:
+            os.remove(self._file(key))
+            return True
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return False
+
+    def has(self, key):
+        return os.path.exists(self._file(key))
+
+    __contains__ = has
+
+    def keys(self):
+        return list(self.iterkeys())
+
+    def iterkeys(self):
+        for key, _ in self._iter(record=False):
+            yield key
+
+    def iteritems(self):
+        """Lazily yields (key, record) pairs, reading one record file
+        at a time.
+        """
+        return self._iter()
+
+    def _iter(self, record=True):
+        for shard in self._shards():
+            for name in os.listdir(shard):
+                if name.startswith('.'):
+                    continue
+                try:
+                    yield self._read(os.path.join(shard, name), record)
+                except IOError as e:
+                    # record was deleted since listing its shard
+                    if e.errno != errno.ENOENT:
+                        raise
+
+    __iter__ = iterkeys
+
+    def __len__(self):
+        return sum(len([n for n in os.listdir(shard)
+                        if not n.startswith('.')])
+                   for shard in self._shards())